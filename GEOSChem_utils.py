@@ -0,0 +1,933 @@
+import bisect
+import fnmatch
+import glob
+import json
+import os
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import cartopy.crs as ccrs
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+from NACHTT_utils import Loader, Processor, _per_variable
+from profiling_utils import instrument
+from render_utils import FrameWriter
+
+
+class BaseMap:
+    """
+    A cartopy map whose background (features, gridlines, extent) and lon/lat mesh are built once,
+    so a loop over daily files only swaps the pcolormesh data and the title for each frame.
+
+    The figure is created without pyplot, so it is not closed by plt.close('all') and can be
+    reused for as long as the map is cached (see get_base_map).
+    """
+    def __init__(self, lon, lat, extent, background=None, overlay=None, figsize=(16, 12), mesh_kwargs=None, title_kwargs=None,
+                 colorbar_kwargs=None, autoscale=None):
+        """
+        Parameters:
+        - lon, lat: 1-D arrays of grid-cell centers.
+        - extent: (lon_min, lon_max, lat_min, lat_max) of the map.
+        - background: Function called once with the GeoAxes to draw features, gridlines, etc. below the mesh.
+        - overlay: Function called once with the GeoAxes to draw markers or annotations above the mesh.
+        - figsize: Figure size in inches.
+        - mesh_kwargs: Keyword arguments for pcolormesh (e.g. cmap, vmin, vmax).
+        - title_kwargs: Keyword arguments for the axes title (e.g. fontsize, pad).
+        - colorbar_kwargs: If given, a colorbar is added with these arguments ('label' sets its label).
+        - autoscale: Rescale the color limits to each frame's data. None (default) autoscales unless
+          mesh_kwargs fixes the limits (vmin/vmax or norm); False requires such fixed limits.
+        """
+        fixed_limits = any(key in (mesh_kwargs or {}) for key in ('vmin', 'vmax', 'norm'))
+        if autoscale is None:
+            autoscale = not fixed_limits
+        elif not autoscale and not fixed_limits:
+            # The placeholder mesh would otherwise freeze the color limits at (0, 0)
+            raise ValueError('autoscale=False needs vmin/vmax or norm in mesh_kwargs')
+
+        self.fig = Figure(figsize=figsize)
+        FigureCanvasAgg(self.fig)
+        self.ax = self.fig.add_subplot(1, 1, 1, projection=ccrs.PlateCarree())
+        self.autoscale = autoscale
+
+        if background is not None:
+            background(self.ax)
+        self.ax.set_extent(list(extent), crs=ccrs.PlateCarree())
+
+        lon2d, lat2d = np.meshgrid(lon, lat)
+        mesh_kwargs = dict(mesh_kwargs or {})
+        mesh_kwargs.setdefault('transform', ccrs.PlateCarree())
+        self.mesh = self.ax.pcolormesh(lon2d, lat2d, np.zeros(lon2d.shape), **mesh_kwargs)
+
+        if overlay is not None:
+            overlay(self.ax)
+
+        self.colorbar = None
+        if colorbar_kwargs is not None:
+            colorbar_kwargs = dict(colorbar_kwargs)
+            label = colorbar_kwargs.pop('label', None)
+            self.colorbar = self.fig.colorbar(self.mesh, ax=self.ax, **colorbar_kwargs)
+            if label is not None:
+                self.colorbar.set_label(label)
+
+        self.title = self.ax.set_title('', **(title_kwargs or {}))
+
+    def update(self, data, title=None):
+        """
+        Replaces the mesh data (a 2-D lat x lon array) and, optionally, the title.
+        """
+        self.mesh.set_array(np.ma.masked_invalid(np.asarray(data)))
+        if self.autoscale:
+            self.mesh.autoscale()
+        if title is not None:
+            self.title.set_text(title)
+
+    def save(self, path, **savefig_kwargs):
+        with instrument.stage('savefig'):
+            self.fig.savefig(path, **savefig_kwargs)
+        instrument.count('figures')
+
+    def save_sequence(self, frames, path, **writer_kwargs):
+        """
+        Draws a sequence of frames on this map and streams them into one animation (.gif/.mp4) or
+        tiled contact-sheet image (see render_utils.FrameWriter, which takes writer_kwargs).
+
+        Parameters:
+        - frames: Iterable of (data, title) pairs, e.g. one per daily file.
+        - path: Output file; its extension selects the format.
+
+        Returns:
+        - n_frames: Number of frames written.
+        """
+        with FrameWriter(self.fig, path, **writer_kwargs) as writer:
+            for data, title in frames:
+                self.update(data, title=title)
+                with instrument.stage('savefig'):
+                    writer.add_frame()
+        instrument.count('figures')
+        return writer.n_frames
+
+
+# Base maps cached per process, keyed on background, extent and grid
+_base_maps = {}
+
+
+def _function_key(func):
+    return (getattr(func, '__module__', None), getattr(func, '__qualname__', None))
+
+
+def get_base_map(lon, lat, extent, background=None, overlay=None, **kwargs):
+    """
+    Returns a cached BaseMap for this (background, overlay, extent, grid, options), building it on first use.
+    Takes the same arguments as BaseMap.
+    """
+    lon, lat = np.asarray(lon), np.asarray(lat)
+    key = (_function_key(background), _function_key(overlay), tuple(extent),
+           lon.shape, lat.shape, lon[0], lon[-1], lat[0], lat[-1], repr(sorted(kwargs.items())))
+    if key not in _base_maps:
+        _base_maps[key] = BaseMap(lon, lat, extent, background=background, overlay=overlay, **kwargs)
+    return _base_maps[key]
+
+
+@instrument.timed()
+def _open_loaded(path, variables=None, bbox=None):
+    # Open, subset and fully read one file, then release its file handle
+    ds = xr.open_dataset(path) if bbox is None else open_region(path, bbox, variables=variables)
+    with ds:
+        if variables is not None and bbox is None:
+            ds = ds[list(variables)]
+        return ds.load()
+
+
+def prefetch_datasets(paths, variables=None, bbox=None, depth=2, workers=2, max_bytes=None, open_func=None):
+    """
+    Iterates over (path, dataset) pairs in order while the next files are opened and decoded on a
+    background thread pool, so reading file N+1 (e.g. from the network filesystem) overlaps with
+    reducing and rendering file N.
+
+    Each dataset is fully loaded with its file closed, so the caller can use it without further I/O.
+
+    Parameters:
+    - paths: File paths, in the order they should be yielded.
+    - variables: Optional list of variables to read (coordinates are always kept).
+    - bbox: Optional (lon_min, lon_max, lat_min, lat_max); only the cells inside it are read (see open_region).
+    - depth: Maximum number of files read ahead of the one being consumed (default 2).
+    - workers: Number of reader threads (default 2).
+    - max_bytes: Optional bound on the memory held by read-ahead files; read-ahead is reduced so the
+      files waiting in the queue (estimated from the largest file seen so far) stay under it.
+    - open_func: Optional function(path) -> loaded Dataset replacing the default reader.
+
+    Example:
+        for path, ds in prefetch_datasets(nc_paths, variables=['EMIS_DST1'], depth=3):
+            ...
+    """
+    if open_func is None:
+        def open_func(path):
+            return _open_loaded(path, variables=variables, bbox=bbox)
+
+    paths = list(paths)
+    pending = deque()
+    largest = 0
+    next_index = 0
+
+    executor = ThreadPoolExecutor(max_workers=max(1, workers))
+    try:
+        while next_index < len(paths) or pending:
+            # Keep up to depth files in flight, within the memory budget (always at least one)
+            while next_index < len(paths) and len(pending) < max(1, depth):
+                if pending and max_bytes is not None and largest and (len(pending) + 1) * largest > max_bytes:
+                    break
+                pending.append((paths[next_index], executor.submit(open_func, paths[next_index])))
+                next_index += 1
+
+            path, future = pending.popleft()
+            with instrument.stage('prefetch_wait'):
+                ds = future.result()
+            largest = max(largest, ds.nbytes)
+            instrument.add_bytes(os.path.basename(str(path)), ds.nbytes)
+            yield path, ds
+    finally:
+        # The consumer may stop early; drop whatever has not started yet
+        for _, future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+@instrument.timed()
+def reduce_species_conc(file_paths, species, lev=None, time_var='time', lev_dim='lev', bbox=None, prefetch=0):
+    """
+    Streams over a collection of SpeciesConc files one at a time, reading only the requested species
+    and levels, and returns their means over time and level.
+
+    Running sums and counts are kept per species, so memory stays bounded by one file's worth of
+    one species rather than the whole run.
+
+    Parameters:
+    - file_paths: List of SpeciesConc (or any lat/lon/time[/lev]) files, in time order.
+    - species: List of variable names (e.g. ['SpeciesConcVV_ClNO2', 'SpeciesConcVV_O3']).
+    - lev: Level selection passed to isel (an index, slice or list of indices); None for all levels.
+    - time_var: Name of the time dimension (default 'time').
+    - lev_dim: Name of the level dimension (default 'lev').
+    - bbox: Optional (lon_min, lon_max, lat_min, lat_max); only the cells inside it are read and reduced.
+    - prefetch: Number of files to read ahead on background threads (see prefetch_datasets); 0 reads
+      each file only when it is reduced, one species at a time.
+
+    Returns:
+    - dict with xarray Datasets of (lat, lon) mean fields for every species:
+      'campaign_mean': mean over every file,
+      'daily_mean': with a 'date' dimension (calendar days of the time coordinate),
+      'per_file': with a 'file' dimension (file basenames).
+    """
+    if isinstance(species, str):
+        species = [species]
+
+    total = {}
+    daily = {}
+    per_file = {var: [] for var in species}
+    file_names = []
+    coords = None
+
+    if prefetch:
+        opened = prefetch_datasets(file_paths, variables=species, bbox=bbox, depth=prefetch)
+    else:
+        opened = ((path, xr.open_dataset(path) if bbox is None else open_region(path, bbox, variables=species)) for path in file_paths)
+
+    for path, ds in opened:
+        with ds:
+            if coords is None:
+                coords = {'lat': ds['lat'].values, 'lon': ds['lon'].values}
+            dates = pd.to_datetime(ds[time_var].values).normalize()
+            file_names.append(os.path.basename(path))
+
+            for var in species:
+                data = ds[var]
+                if lev is not None and lev_dim in data.dims:
+                    data = data.isel({lev_dim: lev})
+
+                # Only this species (and level range) is read from disk
+                values = data.transpose(time_var, ..., 'lat', 'lon').values.astype(float)
+                values = values.reshape(values.shape[0], -1, *values.shape[-2:])
+                valid = ~np.isnan(values)
+                sums = np.where(valid, values, 0).sum(axis=1)
+                counts = valid.sum(axis=1)
+
+                file_sum, file_count = sums.sum(axis=0), counts.sum(axis=0)
+                per_file[var].append(_safe_mean(file_sum, file_count))
+                _accumulate(total, var, file_sum, file_count)
+
+                for date in dates.unique():
+                    in_day = dates == date
+                    _accumulate(daily, (var, date), sums[in_day].sum(axis=0), counts[in_day].sum(axis=0))
+
+    dims = ('lat', 'lon')
+    dates = sorted({date for _, date in daily})
+    return {
+        'campaign_mean': xr.Dataset({var: (dims, _safe_mean(*total[var])) for var in species}, coords=coords),
+        'daily_mean': xr.Dataset({var: (('date',) + dims, np.stack([_safe_mean(*daily[(var, date)]) for date in dates]))
+                                  for var in species}, coords=dict(coords, date=pd.DatetimeIndex(dates))),
+        'per_file': xr.Dataset({var: (('file',) + dims, np.stack(per_file[var])) for var in species},
+                               coords=dict(coords, file=file_names)),
+    }
+
+
+def _accumulate(accumulator, key, sums, counts):
+    if key in accumulator:
+        accumulator[key][0] += sums
+        accumulator[key][1] += counts
+    else:
+        accumulator[key] = [sums.copy(), counts.copy()]
+
+
+def _safe_mean(sums, counts):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+
+class GridIndex:
+    """
+    Nearest-gridcell lookup for a regular model grid (e.g. 2x2.5 or 0.5x0.625), built once per grid.
+
+    Cell boundaries are taken halfway between neighbouring centers, so many (lat, lon) sites are mapped
+    to cell indices with one searchsorted per axis instead of a scan over the coordinate arrays per site.
+    """
+    def __init__(self, lat, lon):
+        self.lat = np.asarray(lat, dtype=float)
+        self.lon = np.asarray(lon, dtype=float)
+        if np.any(np.diff(self.lat) <= 0) or np.any(np.diff(self.lon) <= 0):
+            raise ValueError('GridIndex requires strictly increasing lat and lon coordinates')
+
+        self._lat_bounds = (self.lat[1:] + self.lat[:-1]) / 2
+        self._lon_bounds = (self.lon[1:] + self.lon[:-1]) / 2
+
+    @classmethod
+    def from_dataset(cls, ds):
+        return cls(ds['lat'].values, ds['lon'].values)
+
+    def locate(self, lats, lons):
+        """
+        Returns (lat_idx, lon_idx) integer arrays of the cells nearest to each (lat, lon) site.
+        Longitudes are wrapped onto the grid's 360-degree range (e.g. 250E -> -110).
+        """
+        lats = np.atleast_1d(np.asarray(lats, dtype=float))
+        lons = np.atleast_1d(np.asarray(lons, dtype=float))
+
+        # Wrap longitudes so the seam between the last and first cell is handled as well
+        spacing = self.lon[1] - self.lon[0] if len(self.lon) > 1 else 360.0
+        west_edge = self.lon[0] - spacing / 2
+        lons = (lons - west_edge) % 360.0 + west_edge
+
+        lat_idx = np.searchsorted(self._lat_bounds, lats)
+        lon_idx = np.searchsorted(self._lon_bounds, lons)
+        if len(self.lon) > 1:
+            # Points past the last cell's eastern edge belong to the first cell
+            lon_idx[lons >= self.lon[-1] + spacing / 2] = 0
+        return lat_idx, lon_idx
+
+    def region_slices(self, bbox, pad=1):
+        """
+        Returns {'lat': slice, 'lon': slice} index slices of the cells overlapping a bounding box.
+
+        Parameters:
+        - bbox: (lon_min, lon_max, lat_min, lat_max), in the same order as a cartopy extent.
+        - pad: Extra cells kept on each side, so a map drawn with this extent is filled to its edges.
+        """
+        lon_min, lon_max, lat_min, lat_max = bbox
+        if lon_min > lon_max or lat_min > lat_max:
+            raise ValueError(f'Bounding box {bbox} must be (lon_min, lon_max, lat_min, lat_max) without crossing the dateline')
+
+        # The cells containing each corner, from the same midpoint boundaries used by locate
+        lat0 = max(np.searchsorted(self._lat_bounds, lat_min) - pad, 0)
+        lat1 = min(np.searchsorted(self._lat_bounds, lat_max) + 1 + pad, len(self.lat))
+        lon0 = max(np.searchsorted(self._lon_bounds, lon_min) - pad, 0)
+        lon1 = min(np.searchsorted(self._lon_bounds, lon_max) + 1 + pad, len(self.lon))
+        return {'lat': slice(int(lat0), int(lat1)), 'lon': slice(int(lon0), int(lon1))}
+
+    @instrument.timed()
+    def extract(self, ds, sites, variables, lev=None, lev_dim='lev'):
+        """
+        Extracts every site x variable timeseries from ds with one vectorized (pointwise) isel per variable.
+
+        Parameters:
+        - ds: xarray Dataset on this grid (can be a lazy multi-file dataset; only the selected cells are read).
+        - sites: List of (lat, lon) tuples, or a dict of site name -> (lat, lon).
+        - variables: List of variable names.
+        - lev: Level index (or list/slice) applied to variables that have a lev_dim; None keeps all levels.
+
+        Returns:
+        - xarray Dataset with a 'site' dimension (plus time and any remaining levels) and
+          'site_lat'/'site_lon' coordinates of the requested locations.
+        """
+        names = list(sites) if isinstance(sites, dict) else list(range(len(sites)))
+        coords = np.array(list(sites.values()) if isinstance(sites, dict) else sites, dtype=float).reshape(-1, 2)
+        lat_idx, lon_idx = self.locate(coords[:, 0], coords[:, 1])
+
+        points = {'lat': xr.DataArray(lat_idx, dims='site'), 'lon': xr.DataArray(lon_idx, dims='site')}
+        extracted = {}
+        for var in variables:
+            # Variables without lat/lon (e.g. per-level weights) are kept whole
+            selection = {dim: index for dim, index in points.items() if dim in ds[var].dims}
+            if lev is not None and lev_dim in ds[var].dims:
+                selection[lev_dim] = lev
+            extracted[var] = ds[var].isel(selection)
+
+        return xr.Dataset(extracted).assign_coords(site=names, site_lat=('site', coords[:, 0]), site_lon=('site', coords[:, 1]))
+
+    @instrument.timed()
+    def extract_profiles(self, ds, sites, variables, levels=None, weights=None, hours=None, local_offset=0,
+                         lev_dim='lev', time_var='time'):
+        """
+        Extracts vertical profiles of many species at many sites in one pointwise read of the requested
+        levels, with optional pressure-weighted layer averages (e.g. boundary-layer means) and time-mean
+        profiles over selected hours (e.g. nighttime profiles for the elevator comparison).
+
+        Parameters:
+        - ds: xarray Dataset on this grid with a lev_dim (can be lazy; only the selected cells and levels are read).
+        - sites: List of (lat, lon) tuples, or a dict of site name -> (lat, lon).
+        - variables: List of variable names with a lev_dim.
+        - levels: Level indices to read: a slice (e.g. slice(0, 10) for the lowest 10 levels), list or None for all.
+        - weights: Optional layer weights for the layer average: the name of a variable in ds (e.g. the pressure
+          thickness 'Met_DELPDRY') or a DataArray broadcastable to (time, lev, lat, lon). None weights levels equally.
+        - hours: Optional hours of day (0-23, in local time) to keep, e.g. [20, 21, 22, 23, 0, 1, 2, 3, 4, 5].
+        - local_offset: Timezone offset in hours used to select hours (default 0).
+
+        Returns:
+        - xarray Dataset with a 'site' dimension and, for each variable:
+          '<var>': the (site, time, lev) profile cube,
+          '<var>_layer_mean': the (site, time) weighted mean over the selected levels,
+          '<var>_profile': the (site, lev) mean profile over the selected times.
+        """
+        if isinstance(variables, str):
+            variables = [variables]
+        if isinstance(levels, int):
+            levels = [levels]
+
+        selection = {}
+        if levels is not None:
+            selection[lev_dim] = levels
+        if hours is not None:
+            local_hours = (pd.to_datetime(ds[time_var].values) + pd.to_timedelta(local_offset, unit='h')).hour
+            selection[time_var] = np.flatnonzero(np.isin(local_hours, list(hours)))
+
+        names = list(variables)
+        if isinstance(weights, str):
+            names.append(weights)
+            weight_name = weights
+        elif weights is not None:
+            ds = ds.assign(_layer_weight=weights)
+            names.append('_layer_weight')
+            weight_name = '_layer_weight'
+
+        # One pointwise read of every variable (and the weights) at the selected sites, levels and times
+        cube = self.extract(ds[names].isel(selection), sites, names).load()
+
+        result = {}
+        for var in variables:
+            data = cube[var].transpose('site', time_var, lev_dim)
+            if weights is not None:
+                w = cube[weight_name].broadcast_like(data).transpose('site', time_var, lev_dim).where(data.notnull())
+            else:
+                w = xr.ones_like(data).where(data.notnull())
+            with np.errstate(invalid='ignore', divide='ignore'):
+                result[var] = data
+                result[f'{var}_layer_mean'] = (data * w).sum(lev_dim) / w.sum(lev_dim).where(w.sum(lev_dim) > 0)
+                result[f'{var}_profile'] = data.mean(time_var)
+        return xr.Dataset(result)
+
+
+def open_region(path, bbox, variables=None, pad=1):
+    """
+    Opens a lat/lon NetCDF file (e.g. a HEMCO or SpeciesConc file) lazily, restricted to the cells inside
+    a bounding box. Only the lat/lon coordinates are read up front; the bounding box is turned into index
+    slices so any later reduction (max over time, mean over levels, ...) reads only the subdomain from disk.
+
+    Parameters:
+    - path: NetCDF file path.
+    - bbox: (lon_min, lon_max, lat_min, lat_max), e.g. the map extent.
+    - variables: Optional list of variables to keep (coordinates are always kept).
+    - pad: Extra cells kept on each side of the bounding box (default 1).
+
+    Returns:
+    - xarray Dataset of the subdomain (close it, or use it as a context manager, when done)
+    """
+    ds = xr.open_dataset(path)
+    if variables is not None:
+        ds = ds[list(variables)]
+    region = ds.isel(GridIndex.from_dataset(ds).region_slices(bbox, pad=pad))
+    region.encoding['sources'] = [path]
+    region.set_close(ds.close)
+    return region
+
+
+@instrument.timed()
+def load_site_table(source, variables, sites, start=None, end=None, lev=0, scale_factor=1, units=None,
+                    time_var='time', loader=None):
+    """
+    Reads selected variables from several diagnostic collections (e.g. level-1 SpeciesConc and 10 m
+    concentrations) at a set of sites and returns them as one table.
+
+    Each collection is opened lazily with only its requested variables, concatenated along time and
+    restricted to [start, end]; the site cells and level are selected and the unit conversion applied
+    lazily, so only the selected points are read, once, when the table is built.
+
+    Parameters:
+    - source: An OutputDir path (files named '*.<collection>.*.nc4') or a FileCatalog.
+    - variables: dict of collection -> list of variable names,
+      e.g. {'SpeciesConc': ['SpeciesConcVV_O3'], 'ConcAboveSfc': ['SpeciesConc10m_O3']}.
+    - sites: List of (lat, lon) tuples, or a dict of site name -> (lat, lon).
+    - start, end: Optional time bounds.
+    - lev: Level index applied to variables that have a 'lev' dimension (default 0, the first level).
+    - scale_factor: Scale applied to every variable, or a dict keyed by variable name (e.g. 1e9 for ppbv).
+    - units: Optional units string (or dict keyed by variable name) recorded in table.attrs['units'].
+    - time_var: Name of the time dimension (default 'time').
+
+    Returns:
+    - pandas DataFrame indexed by (site, time) with one column per variable plus 'site_lat'/'site_lon'
+    """
+    loader = loader if loader is not None else Loader()
+    columns = []
+    for collection, names in variables.items():
+        if isinstance(source, FileCatalog):
+            paths = source.query(collection, start, end, variables=names)
+        else:
+            paths = sorted(glob.glob(os.path.join(source, f'*.{collection}.*.nc4')), key=parse_file_time)
+            if start is not None or end is not None:
+                # Each file covers from its timestamp up to the next file's, so keep the one spanning start
+                times = [parse_file_time(path) for path in paths]
+                next_times = times[1:] + [pd.Timestamp.max]
+                paths = [path for path, t, t_next in zip(paths, times, next_times)
+                         if (start is None or t_next > pd.to_datetime(start)) and (end is None or t <= pd.to_datetime(end))]
+        if not paths:
+            raise FileNotFoundError(f'No {collection} files with {names} in {source}')
+
+        ds = loader.open(paths if len(paths) > 1 else paths[0], variables=names, time_var=time_var)
+        if start is not None or end is not None:
+            ds = ds.sel({time_var: slice(start, end)})
+        columns.append(GridIndex.from_dataset(ds).extract(ds, sites, names, lev=lev))
+
+    table = xr.merge(columns, join='outer', compat='override')
+    for name in table.data_vars:
+        scale = _per_variable(scale_factor, name, default=1)
+        if scale != 1:
+            table[name] = table[name] * scale
+
+    frame = table.transpose('site', time_var).to_dataframe(dim_order=['site', time_var])
+    frame = frame[[name for names in variables.values() for name in names] + ['site_lat', 'site_lon']]
+    if units is not None:
+        frame.attrs['units'] = dict(units) if isinstance(units, dict) else {name: units for names in variables.values() for name in names}
+    return frame
+
+
+@instrument.timed()
+def aggregate_emissions(sources, variables, threshold=0, period=None, bbox=None, time_var='time', prefetch=0):
+    """
+    Reduces many HEMCO emission variables (e.g. EMIS_DST1-4) over time across a collection of files,
+    reading each file's variables as one stacked (time, species, lat, lon) block and reducing it in
+    one pass, so composites over a whole month need no per-day reloads or per-species intermediates.
+
+    Parameters:
+    - sources: List of file paths (or open xarray Datasets), in any order.
+    - variables: List of emission variable names.
+    - threshold: Value an emission must exceed to count in the exceedance masks (default 0).
+    - period: Optional pandas period frequency (e.g. 'M' for monthly, 'D' for daily) to composite each
+      period separately; None gives one composite over every source.
+    - bbox: Optional (lon_min, lon_max, lat_min, lat_max); only the cells inside it are read.
+    - time_var: Name of the time dimension (default 'time').
+    - prefetch: Number of files to read ahead on background threads (see prefetch_datasets); 0 reads
+      each file only when it is reduced.
+
+    Returns:
+    - xarray Dataset with (species, lat, lon) variables 'max', 'sum', 'mean', 'count' and 'exceedance'
+      (True where the species exceeded threshold at any time), plus (lat, lon) 'total_max' (the sum of
+      the species maxima) and 'exceedance_any' (any species exceeded threshold). With period, every
+      variable also has a leading 'period' dimension.
+    """
+    if isinstance(variables, str):
+        variables = [variables]
+    sources = list(sources)
+
+    # Running reductions per period label: [max, sum, count, exceedance]
+    partials = {}
+    coords = None
+    def opened():
+        # (dataset, whether it was opened here and must be closed) for every source, already subset to bbox
+        if prefetch and all(isinstance(source, str) for source in sources):
+            for _, ds in prefetch_datasets(sources, variables=variables, bbox=bbox, depth=prefetch):
+                yield ds, True
+            return
+        for source in sources:
+            if isinstance(source, str):
+                yield (xr.open_dataset(source) if bbox is None else open_region(source, bbox, variables=variables)), True
+            else:
+                yield (source if bbox is None else source.isel(GridIndex.from_dataset(source).region_slices(bbox))), False
+
+    for ds, owned in opened():
+        try:
+            if coords is None:
+                coords = {'lat': ds['lat'].values, 'lon': ds['lon'].values}
+            block = ds[variables].to_array(dim='species').transpose(time_var, 'species', 'lat', 'lon').values
+            labels = (pd.to_datetime(ds[time_var].values).to_period(period) if period is not None
+                      else np.zeros(block.shape[0], dtype=int))
+        finally:
+            if owned:
+                ds.close()
+
+        for label in pd.unique(labels):
+            part = block[labels == label] if period is not None else block
+            valid = ~np.isnan(part)
+            reduced = [np.fmax.reduce(part, axis=0), np.where(valid, part, 0).sum(axis=0), valid.sum(axis=0),
+                       (part > threshold).any(axis=0)]
+            if label not in partials:
+                partials[label] = reduced
+            else:
+                total = partials[label]
+                total[0] = np.fmax(total[0], reduced[0])
+                total[1] += reduced[1]
+                total[2] += reduced[2]
+                total[3] |= reduced[3]
+
+    if not partials:
+        raise ValueError('aggregate_emissions needs at least one source')
+
+    def composite(maximum, sums, counts, exceedance):
+        dims = ('species', 'lat', 'lon')
+        return xr.Dataset({
+            'max': (dims, maximum), 'sum': (dims, sums), 'mean': (dims, _safe_mean(sums, counts)), 'count': (dims, counts),
+            'exceedance': (dims, exceedance), 'total_max': (dims[1:], np.nansum(maximum, axis=0)),
+            'exceedance_any': (dims[1:], exceedance.any(axis=0)),
+        }, coords=dict(coords, species=list(variables)))
+
+    if period is None:
+        return composite(*partials[0])
+    labels = sorted(partials)
+    return xr.concat([composite(*partials[label]) for label in labels], dim='period').assign_coords(
+        period=[str(label) for label in labels])
+
+
+class RunSet:
+    """
+    A set of GEOS-Chem run directories with the same output layout (e.g. sensitivity runs), whose
+    outputs are opened lazily and stacked along a 'run' dimension so diagnostics are computed for
+    every run in one pass instead of one script per run.
+    """
+    def __init__(self, run_dirs, baseline=None, loader=None, processor=None):
+        """
+        Parameters:
+        - run_dirs: dict of run name -> run directory, or a list of run directories (named by basename).
+        - baseline: Name of the run that differences are taken against (default: the first run).
+        - loader, processor: Optional NACHTT_utils Loader/Processor instances to use.
+        """
+        if not isinstance(run_dirs, dict):
+            run_dirs = {os.path.basename(os.path.normpath(path)): path for path in run_dirs}
+        self.run_dirs = dict(run_dirs)
+        self.baseline = baseline if baseline is not None else next(iter(self.run_dirs))
+        self.loader = loader if loader is not None else Loader()
+        self.processor = processor if processor is not None else Processor()
+
+    @classmethod
+    def discover(cls, root, pattern='gc_*', baseline=None, **kwargs):
+        """
+        Finds every run directory under root matching pattern that has an OutputDir.
+        """
+        run_dirs = sorted(path for path in glob.glob(os.path.join(root, pattern)) if os.path.isdir(os.path.join(path, 'OutputDir')))
+        if not run_dirs:
+            raise FileNotFoundError(f'No run directories matching {pattern} with an OutputDir under {root}')
+        return cls(run_dirs, baseline=baseline, **kwargs)
+
+    def _stack(self, datasets, dim, time_var):
+        sizes = {name: ds.sizes[dim] for name, ds in datasets.items()}
+        if len(set(sizes.values())) > 1:
+            raise ValueError(f'Runs have different lengths along {dim}: {sizes}')
+        # Same length is not enough: runs over different periods would be relabelled onto the first run's times
+        reference_name, reference = next(iter(datasets.items()))
+        reference_time = reference[time_var].values
+        for name, ds in datasets.items():
+            if not np.array_equal(ds[time_var].values, reference_time):
+                raise ValueError(f"Runs '{reference_name}' and '{name}' have different {time_var} values")
+        # Runs share the coordinates of the first run (same output layout)
+        return xr.concat(list(datasets.values()), dim=pd.Index(list(datasets), name='run'),
+                         data_vars='all', coords='minimal', compat='override', join='override')
+
+    def open_plane_logs(self, variables=None, pattern='OutputDir/Plane_Logs/planelog_concat_*.nc', time_var='time_UTC'):
+        """
+        Lazily opens the plane logs of every run (only the requested variables) stacked along 'run'.
+        """
+        datasets = {}
+        for name, run_dir in self.run_dirs.items():
+            paths = sorted(glob.glob(os.path.join(run_dir, pattern)))
+            if not paths:
+                raise FileNotFoundError(f'No plane logs matching {pattern} in {run_dir}')
+            datasets[name] = self.loader.open(paths[0] if len(paths) == 1 else paths, variables=variables, time_var=time_var)
+        return self._stack(datasets, datasets[self.baseline][time_var].dims[0], time_var)
+
+    def open_species_conc(self, species, collection='SpeciesConc', lev=None, time_var='time'):
+        """
+        Lazily opens a diagnostic collection (only the requested species and levels) of every run, stacked along 'run'.
+        """
+        datasets = {}
+        for name, run_dir in self.run_dirs.items():
+            paths = sorted(glob.glob(os.path.join(run_dir, 'OutputDir', f'*.{collection}.*.nc4')))
+            if not paths:
+                raise FileNotFoundError(f'No {collection} files in {run_dir}')
+            ds = self.loader.open(paths, variables=species, time_var=time_var)
+            if lev is not None and 'lev' in ds.dims:
+                ds = ds.isel(lev=lev)
+            datasets[name] = ds
+        return self._stack(datasets, time_var, time_var)
+
+    def diurnal_cycles(self, stacked, variables, time_var='time_UTC', local_offset=0, scale_factor=1, percentiles=(25, 75)):
+        """
+        Hourly statistics of every run x variable in one vectorized pass (see Processor.get_diurnal_stats).
+
+        Returns:
+        - xarray Dataset of (run, hour) arrays named '<variable>_<statistic>' (e.g. 'ClNO2_mean').
+        """
+        runs = list(stacked['run'].values)
+        time = stacked[time_var].isel(run=0, drop=True) if 'run' in stacked[time_var].dims else stacked[time_var]
+
+        # Flatten run x variable into one block of rows sharing the time axis
+        flat = xr.Dataset({f'{var}|{run}': stacked[var].sel(run=run, drop=True) for var in variables for run in runs})
+        flat[time_var] = time
+        scales = {f'{var}|{run}': _per_variable(scale_factor, var, default=1)
+                  for var in variables for run in runs}
+        stats = self.processor.get_diurnal_stats(flat, list(flat.data_vars), scale_factor=scales, time_var=time_var,
+                                                 local_offset=local_offset, percentiles=percentiles)
+
+        result = {}
+        for var in variables:
+            for stat in stats[f'{var}|{runs[0]}'].columns:
+                result[f'{var}_{stat}'] = (('run', 'hour'), np.stack([stats[f'{var}|{run}'][stat].values for run in runs]))
+        return xr.Dataset(result, coords={'run': runs, 'hour': np.arange(24)})
+
+    def peak_stats(self, stacked, variables, n=5, time_var='time_UTC', average_interval=None, scale_factor=1):
+        """
+        Summary statistics and top-n values of every run x variable, vectorized over the run dimension.
+
+        Returns:
+        - xarray Dataset with (run,) arrays '<variable>_<mean|median|std|min|max>' and (run, rank) arrays
+          '<variable>_top_value' and '<variable>_top_time'.
+        """
+        time = stacked[time_var].isel(run=0, drop=True) if 'run' in stacked[time_var].dims else stacked[time_var]
+        time_dim = time.dims[0]
+
+        # Number of ranks, shared by every variable (and defined even without variables)
+        n_time = time.sizes[time_dim]
+        if average_interval:
+            n_time = len(pd.Series(0, index=pd.DatetimeIndex(time.values)).resample(average_interval).mean())
+        k = min(n, n_time)
+
+        result = {}
+        for var in variables:
+            scale = _per_variable(scale_factor, var, default=1)
+            data = (stacked[var] * scale).assign_coords({time_dim: time.values}).transpose('run', time_dim)
+            if average_interval:
+                data = data.resample({time_dim: average_interval}).mean()
+            values = data.values
+            times = data[time_dim].values
+
+            result[f'{var}_mean'] = ('run', np.nanmean(values, axis=1))
+            result[f'{var}_median'] = ('run', np.nanmedian(values, axis=1))
+            result[f'{var}_std'] = ('run', np.nanstd(values, axis=1, ddof=1))
+            result[f'{var}_min'] = ('run', np.nanmin(values, axis=1))
+            result[f'{var}_max'] = ('run', np.nanmax(values, axis=1))
+
+            # Top n per run: partition then sort only the n candidates (NaNs rank last)
+            ranked = np.where(np.isnan(values), -np.inf, values)
+            top = np.argpartition(-ranked, k - 1, axis=1)[:, :k]
+            top = np.take_along_axis(top, np.argsort(-np.take_along_axis(ranked, top, axis=1), axis=1), axis=1)
+            result[f'{var}_top_value'] = (('run', 'rank'), np.take_along_axis(values, top, axis=1))
+            result[f'{var}_top_time'] = (('run', 'rank'), times[top])
+
+        return xr.Dataset(result, coords={'run': stacked['run'].values, 'rank': np.arange(1, k + 1)})
+
+    def difference(self, result, baseline=None):
+        """
+        Returns result (any Dataset/DataArray with a 'run' dimension) minus the baseline run.
+        """
+        baseline = baseline if baseline is not None else self.baseline
+        numeric = result[[name for name in result.data_vars if result[name].dtype.kind in 'fiu']] if isinstance(result, xr.Dataset) else result
+        return numeric - numeric.sel(run=baseline)
+
+
+# Timestamps embedded in GEOS-Chem and HEMCO file names, most specific first
+_FILE_TIME_PATTERNS = [
+    (re.compile(r'(\d{8})_(\d{4})z'), '%Y%m%d%H%M'),
+    (re.compile(r'(?<!\d)(\d{8})_(\d{4})(?!\d)'), '%Y%m%d%H%M'),
+    (re.compile(r'(?<!\d)(\d{12})(?!\d)'), '%Y%m%d%H%M'),
+    (re.compile(r'(?<!\d)(\d{8})(?!\d)'), '%Y%m%d'),
+    (re.compile(r'(?<!\d)(\d{6})(?!\d)'), '%Y%m'),
+]
+
+
+def parse_file_time(file_name):
+    """
+    Returns the timestamp in a GEOS-Chem or HEMCO file name (e.g. 'GEOSChem.SpeciesConc.20110217_0000z.nc4'
+    or 'dust_emissions_05.20110301.nc') as a pandas Timestamp, or None if it has none.
+    """
+    name = os.path.basename(file_name)
+    for pattern, fmt in _FILE_TIME_PATTERNS:
+        match = pattern.search(name)
+        if match:
+            try:
+                return pd.to_datetime(''.join(match.groups()), format=fmt)
+            except ValueError:
+                continue
+    return None
+
+
+def parse_collection(file_name):
+    """
+    Returns the collection of a GEOS-Chem output file ('GEOSChem.SpeciesConc.20110217_0000z.nc4' -> 'SpeciesConc'),
+    or, for other files, the name up to its timestamp ('dust_emissions_05.20110301.nc' -> 'dust_emissions_05').
+    """
+    name = os.path.basename(file_name)
+    parts = name.split('.')
+    if len(parts) >= 3 and parts[0] == 'GEOSChem':
+        return parts[1]
+    for pattern, _ in _FILE_TIME_PATTERNS:
+        match = pattern.search(name)
+        if match:
+            return name[:match.start()].rstrip('._-') or os.path.splitext(name)[0]
+    return os.path.splitext(name)[0]
+
+
+class FileCatalog:
+    """
+    Persistent index of model output files (collection, time range, path, variables, dims, grid), kept
+    in a JSON file and updated incrementally: only new or modified files have their headers read.
+
+    Files are held sorted by start time per collection (with a running maximum of their end times), so
+    a query by collection and time range is a binary search (O(log n) plus the files returned) with no
+    directory scan or header reads.
+
+    Example:
+        catalog = FileCatalog('OutputDir/catalog.json')
+        catalog.update('OutputDir')
+        paths = catalog.query('SpeciesConc', '2011-02-17', '2011-03-14')
+    """
+    def __init__(self, path='catalog.json', verbose=False):
+        self.path = path
+        self.verbose = verbose
+        self.entries = {}
+        # path -> error message of files the last update() could not read
+        self.unreadable = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f).get('entries', {})
+        self._build_index()
+
+    def _build_index(self):
+        # collection -> (sorted start times as int64 ns, running max of end times, paths in the same order)
+        index = {}
+        for path, entry in self.entries.items():
+            index.setdefault(entry['collection'], []).append((entry['start_ns'], entry['end_ns'], path))
+        self._index = {}
+        for collection, items in index.items():
+            items.sort()
+            max_ends = list(np.maximum.accumulate([end for _, end, _ in items]))
+            self._index[collection] = ([start for start, _, _ in items], max_ends, [path for _, _, path in items])
+
+    def update(self, root, patterns=('*.nc', '*.nc4'), recursive=True, save=True):
+        """
+        Adds new and modified files under root (matching any of patterns) and drops entries, matching
+        the same patterns, whose files are gone. Unchanged files (same mtime and size) are not reopened;
+        files that cannot be read are skipped and listed in self.unreadable.
+
+        Returns:
+        - n_read: Number of files whose headers were read.
+        """
+        root = os.path.abspath(root)
+        found = set()
+        for pattern in patterns:
+            found.update(glob.glob(os.path.join(root, '**', pattern) if recursive else os.path.join(root, pattern),
+                                   recursive=recursive))
+
+        n_read = 0
+        self.unreadable = {}
+        for path in sorted(found):
+            st = os.stat(path)
+            entry = self.entries.get(path)
+            if entry is not None and entry['mtime'] == st.st_mtime_ns and entry['size'] == st.st_size:
+                continue
+            try:
+                self.entries[path] = self._read_entry(path, st)
+                n_read += 1
+            except (OSError, ValueError) as error:
+                self.unreadable[path] = str(error)
+                if self.verbose:
+                    print(f'Skipping unreadable file {path}: {error}')
+
+        # Drop entries of deleted files in this scan's scope only; files other patterns found are kept
+        def in_scope(path):
+            relative = os.path.relpath(path, root)
+            return ((recursive or os.sep not in relative) and path.startswith(root + os.sep)
+                    and any(fnmatch.fnmatch(os.path.basename(path), pattern) for pattern in patterns))
+
+        for path in [path for path in self.entries if path not in found and in_scope(path) and not os.path.exists(path)]:
+            del self.entries[path]
+
+        self._build_index()
+        if save:
+            self.save()
+        return n_read
+
+    def _read_entry(self, path, st):
+        with xr.open_dataset(path, decode_times=True) as ds:
+            time_dim = 'time' if 'time' in ds.coords else None
+            times = pd.to_datetime(ds['time'].values) if time_dim else pd.DatetimeIndex([])
+            grid = {}
+            if 'lat' in ds.coords and 'lon' in ds.coords and ds.sizes.get('lat', 0) > 1 and ds.sizes.get('lon', 0) > 1:
+                grid = {'n_lat': int(ds.sizes['lat']), 'n_lon': int(ds.sizes['lon']),
+                        'd_lat': float(abs(ds['lat'].values[2] - ds['lat'].values[1])) if ds.sizes['lat'] > 2 else None,
+                        'd_lon': float(abs(ds['lon'].values[1] - ds['lon'].values[0]))}
+            variables = {name: list(var.dims) for name, var in ds.data_vars.items()}
+            dims = {name: int(size) for name, size in ds.sizes.items()}
+
+        start = times.min() if len(times) else parse_file_time(path)
+        end = times.max() if len(times) else start
+        if start is None:
+            raise ValueError('no time coordinate or timestamp in the file name')
+        return {'collection': parse_collection(path), 'start_ns': int(start.value), 'end_ns': int(end.value),
+                'variables': variables, 'dims': dims, 'grid': grid, 'mtime': st.st_mtime_ns, 'size': st.st_size}
+
+    def save(self):
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'entries': self.entries}, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def collections(self):
+        return sorted(self._index)
+
+    def query(self, collection, start=None, end=None, variables=None):
+        """
+        Returns the paths, in time order, of the collection's files whose time range overlaps [start, end].
+
+        Parameters:
+        - collection: Collection name (e.g. 'SpeciesConc', 'SpeciesConc10m', 'dust_emissions_05').
+        - start, end: Optional time bounds (anything pandas can parse).
+        - variables: Optional list of variables every returned file must contain.
+        """
+        if collection not in self._index:
+            return []
+        starts, max_ends, paths = self._index[collection]
+        # Files starting after end are out; before i0 every file ended before start
+        start_ns = pd.to_datetime(start).value if start is not None else None
+        i0 = bisect.bisect_left(max_ends, start_ns) if start is not None else 0
+        i1 = bisect.bisect_right(starts, pd.to_datetime(end).value) if end is not None else len(starts)
+        paths = paths[i0:i1]
+        if start is not None:
+            paths = [path for path in paths if self.entries[path]['end_ns'] >= start_ns]
+        if variables is not None:
+            paths = [path for path in paths if all(var in self.entries[path]['variables'] for var in variables)]
+        return paths
+
+    def time_range(self, path):
+        """
+        Returns the (start, end) Timestamps recorded for a cataloged file.
+        """
+        entry = self.entries[os.path.abspath(path)]
+        return pd.Timestamp(entry['start_ns']), pd.Timestamp(entry['end_ns'])
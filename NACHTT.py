@@ -1,23 +1,24 @@
-from NACHTT_utils import Plotter, Processor
-plotter = Plotter()
+from NACHTT_utils import Loader, Plotter, Processor
+from render_utils import BuildManifest, RenderPool
+from report_utils import ReportBuilder
+loader = Loader()
+plotter = Plotter(manifest=BuildManifest('../figures/figure_manifest.json'), verbose=True)
 processor = Processor()
 
-import xarray as xr
-
 
 
 # Load NACHTT Campaign Data
 nachtt_nc_file = (
     "/uufs/chpc.utah.edu/common/home/haskins-group1/data/Campaign_Data/Raw_Data/"
     "NACHTT_2011/data/elevator/NACHTT_2011_1min_Merged.nc")
-nachtt_nc = xr.open_dataset(nachtt_nc_file)
+nachtt_nc = loader.open(nachtt_nc_file, time_var='time')
 
 
 # Load base run model data
 base_nc_file = (
     "/uufs/chpc.utah.edu/common/home/haskins-group1/users/jbail/GEOSChem/GC_RunDirs/gc_2x25_nacht2011_base/"
     "OutputDir/Plane_Logs/planelog_concat_20110217_20110314.nc")
-base_nc = xr.open_dataset(base_nc_file)
+base_nc = loader.open(base_nc_file, time_var='time_UTC')
 
 
 # Plot NACHTT diurnal variation in following:
@@ -35,20 +36,29 @@ plotter.plot_time_series(nachtt_nc, 'ClNO2_pptv', scale_factor=1, time_var='time
 
 
 
-stats, peaks = processor.get_peak_n_values(nachtt_nc, 'ClNO2_pptv', average_interval='30min')
+# Top 5 distinct events: peaks at least 24 h apart, so their +/-12 h windows do not overlap
+stats, peaks = processor.get_peak_n_values(nachtt_nc, 'ClNO2_pptv', average_interval='30min', min_separation='24h')
 peak_times = peaks.time
 peak_xlims = processor.get_xlim_from_peaks(peak_times, hours_before=12, hours_after=12)
 
-for xlim in peak_xlims:
-    plotter.plot_time_series(
-        dataset=nachtt_nc,
-        variable='ClNO2_pptv',
-        xlim=xlim,
-        ylabel='Observed (pptv)',
-        average_interval='30min'
-    )
-
-
-
-
-
+# Zoom in on each peak, reading only the samples inside each (merged) window.
+# Each window is an independent figure job, so render them across all cores.
+pool = RenderPool()
+for window in processor.merge_windows(peak_xlims):
+    pool.submit(plotter.plot_time_series_windows,
+                dataset=nachtt_nc,
+                variable='ClNO2_pptv',
+                windows=[window],
+                ylabel='Observed (pptv)',
+                average_interval='30min',
+                fig_save_path='../figures/{variable}_peak_{start:%Y%m%d_%H%M}.png',
+                label=f'ClNO2 peak {window[0]:%Y-%m-%d %H:%M}')
+pool.run()
+
+
+# Species report: one page (diurnal cycle, time series, top events) per species, rendered across all cores
+# and written into a single PDF in page order; add species to the list to extend the report
+report = ReportBuilder('../figures/NACHTT_report.pdf')
+report.add_species_pages(nachtt_nc_file, ['ClNO2_pptv'], local_offset=-7, average_interval='30min',
+                         ylabel='Observed', min_separation='24h')
+report.build()
@@ -1,11 +1,425 @@
+import functools
+import glob
+import io
+import os
+import weakref
+from collections import OrderedDict
+
+import numpy as np
 import pandas as pd
+import xarray as xr
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+from profiling_utils import instrument
+from render_utils import BuildManifest, dataset_sources
+
+try:
+    import dask
+except ImportError:
+    dask = None
+
+
+class SeriesCache:
+    """
+    LRU cache of time-shifted, scaled and (optionally) resampled pandas Series.
+
+    Entries are keyed on (dataset identity, variable, time_var, local_offset, scale_factor, interval),
+    so repeated Plotter/Processor calls on the same dataset only convert and resample each variable once.
+    Each entry also remembers the dataset's variable objects it was computed from, so reassigning the
+    variable or its time coordinate (e.g. ds['x'] = ds['x'] * 1e3) makes the next lookup a miss.
+    """
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __getstate__(self):
+        # Entries hold weak references, so a pickled cache (e.g. sent to a render worker) starts empty
+        return {'maxsize': self.maxsize}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _dataset_ref(self, dataset):
+        # Keep a weak reference so a recycled id() never serves a stale entry
+        try:
+            return weakref.ref(dataset)
+        except TypeError:
+            return lambda: dataset
+
+    def _lookup(self, key, dataset, source):
+        # source: the dataset Variables the value was computed from (Variables cannot be weakly referenced,
+        # so the entry holds them; replaced variables are released when their stale entry is overwritten)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0]() is dataset and all(a is b for a, b in zip(entry[1], source)):
+            self._entries.move_to_end(key)
+            self.hits += 1
+            instrument.count('series_cache.hits')
+            return entry[2]
+        self.misses += 1
+        instrument.count('series_cache.misses')
+        return None
+
+    def _store(self, key, dataset, source, value):
+        self._entries[key] = (self._dataset_ref(dataset), source, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return value
+
+    def get_time_index(self, dataset, time_var='time', local_offset=0):
+        """
+        Returns dataset[time_var] as a pandas DatetimeIndex shifted by local_offset hours.
+        """
+        key = (id(dataset), None, time_var, local_offset, None, None)
+        source = (_source_variable(dataset, time_var),)
+        time = self._lookup(key, dataset, source)
+        if time is not None:
+            return time
+
+        with instrument.stage('to_datetime'):
+            values = dataset[time_var].values
+            instrument.add_bytes(time_var, values.nbytes)
+            time = pd.to_datetime(values) + pd.to_timedelta(local_offset, unit='h')
+        return self._store(key, dataset, source, time)
+
+    def get_series(self, dataset, variable, time_var='time', local_offset=0, scale_factor=1, average_interval=None):
+        """
+        Returns a pandas Series of dataset[variable] * scale_factor indexed by shifted time,
+        resampled to the mean over average_interval if one is given.
+        The returned Series is shared between callers and must not be modified in place.
+        """
+        key = (id(dataset), variable, time_var, local_offset, scale_factor, average_interval)
+        source = (_source_variable(dataset, variable), _source_variable(dataset, time_var))
+        series = self._lookup(key, dataset, source)
+        if series is not None:
+            return series
+
+        time = self.get_time_index(dataset, time_var=time_var, local_offset=local_offset)
+
+        if average_interval and _is_chunked(dataset[variable]):
+            # Resample block by block so a lazily loaded variable is never fully in memory
+            series = _resample_blocks(dataset, variable, time, time_var, scale_factor, average_interval)
+        else:
+            values = dataset[variable].values
+            instrument.add_bytes(variable, values.nbytes)
+            series = pd.Series(values * scale_factor, index=time, name=variable)
+
+            if average_interval:
+                with instrument.stage('resample'):
+                    series = series.resample(average_interval).mean()
+
+        return self._store(key, dataset, source, series)
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        """
+        Returns a dict with the hit/miss counters and current size of the cache.
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries), 'maxsize': self.maxsize}
+
+
+# Cache shared by every Plotter and Processor unless one is passed explicitly
+series_cache = SeriesCache()
+
+
+def _source_variable(dataset, name):
+    # The xarray Variable holding a variable's data (None for inputs without .variables)
+    variables = getattr(dataset, 'variables', None)
+    if variables is not None and name in variables:
+        return variables[name]
+    return None
+
+
+def _is_chunked(dataarray):
+    return getattr(dataarray, 'chunks', None) is not None
+
+
+def _iter_time_blocks(dataset, variable, time_var='time'):
+    """
+    Yields (i0, i1, values) for consecutive blocks of dataset[variable] along the time dimension,
+    following the dataset's dask chunks so only one block is in memory at a time.
+    """
+    dataarray = dataset[variable]
+    dim = dataset[time_var].dims[0]
+    axis = dataarray.dims.index(dim)
+    sizes = dataarray.chunks[axis] if _is_chunked(dataarray) else (dataarray.shape[axis],)
+
+    i0 = 0
+    for size in sizes:
+        values = dataarray.isel({dim: slice(i0, i0 + size)}).values
+        instrument.add_bytes(variable, values.nbytes)
+        yield i0, i0 + size, values
+        i0 += size
+
+
+def _resample_blocks(dataset, variable, time, time_var, scale_factor, average_interval):
+    # Per-block sums and counts combine exactly into the mean of bins that straddle block edges
+    # Anchor every block's fixed-width bins to the first day of the full record, as a single resample would
+    fixed = isinstance(pd.tseries.frequencies.to_offset(average_interval), pd.offsets.Tick)
+    options = {'origin': time[0].normalize()} if fixed else {}
+    partials = []
+    for i0, i1, values in _iter_time_blocks(dataset, variable, time_var):
+        block = pd.Series(values * scale_factor, index=time[i0:i1])
+        with instrument.stage('resample'):
+            partials.append(block.resample(average_interval, **options).agg(['sum', 'count']))
+
+    totals = pd.concat(partials).groupby(level=0).sum()
+    series = (totals['sum'] / totals['count'].where(totals['count'] > 0)).rename(variable)
+    return series.asfreq(average_interval)
+
+
+def _decimate_minmax(time, values, n_buckets, xlim=None):
+    """
+    Reduces a (time-sorted) line to the first minimum and maximum of each of n_buckets equal-width time
+    buckets (e.g. one per pixel column), in time order, so the drawn envelope and every peak are exactly
+    those of the full line. Buckets whose samples are all NaN keep one NaN point, so data gaps wider than
+    a bucket still break the line. With xlim, only the visible range (plus one sample each side) is bucketed.
+
+    Returns:
+    - time, values: The decimated arrays (at most 2 * n_buckets points, plus the two end samples).
+    """
+    time = np.asarray(time, dtype='datetime64[ns]')
+    values = np.asarray(values, dtype=float)
+
+    if xlim is not None:
+        i0 = max(np.searchsorted(time, np.datetime64(pd.to_datetime(xlim[0]), 'ns'), side='left') - 1, 0)
+        i1 = min(np.searchsorted(time, np.datetime64(pd.to_datetime(xlim[1]), 'ns'), side='right') + 1, len(time))
+        time, values = time[i0:i1], values[i0:i1]
+
+    if len(values) <= 2 * n_buckets:
+        return time, values
+
+    # Bucket of each sample from its position along the time axis
+    ticks = (time - time[0]).astype('int64').astype(float)
+    bucket = np.minimum((ticks * n_buckets / max(ticks[-1], 1)).astype(np.int64), n_buckets - 1)
+    starts = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+    seg = np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, len(values)]))
+
+    with np.errstate(invalid='ignore'):
+        seg_min = np.fmin.reduceat(values, starts)
+        seg_max = np.fmax.reduceat(values, starts)
+
+    # First sample equal to each bucket's min (max); all-NaN buckets keep their first sample
+    keep = np.zeros(len(values), dtype=bool)
+    for target in (seg_min, seg_max):
+        hit = np.flatnonzero(values == target[seg])
+        first = np.unique(seg[hit], return_index=True)[1]
+        keep[hit[first]] = True
+    keep[starts[np.isnan(seg_min)]] = True
+    # Keep the end samples so the line still reaches the plot edges
+    keep[[0, -1]] = True
+    return time[keep], values[keep]
+
+
+def _keep_variables(dataset, keep):
+    # Subset to the requested variables; the time variable is kept only if it is not already a coordinate
+    return dataset[[name for name in keep if name in dataset.data_vars or name not in dataset.coords]]
+
+
+def _per_variable(value, variable_name, default=None):
+    # Options (plot options, scale factors) may be given once for all variables or as a dict keyed by
+    # variable name; variables missing from the dict get default
+    if isinstance(value, dict):
+        return value.get(variable_name, default)
+    return value
+
+
+class StreamingStats:
+    """
+    Single-pass summary statistics (count, mean, std, min, max and median) over blocks of values.
+
+    Moments are merged block by block with Chan et al.'s parallel form of Welford's algorithm, and the
+    median comes from a fixed-size uniform reservoir sample, so it is exact while the number of values
+    is at most sample_size and an unbiased approximation beyond that. NaNs are ignored.
+    """
+    def __init__(self, sample_size=65536, seed=0):
+        self.sample_size = sample_size
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.nan
+        self.max = np.nan
+        self._reservoir = np.empty(sample_size)
+        self._rng = np.random.default_rng(seed)
+
+    def update(self, values, moments=True):
+        # moments=False only feeds the reservoir (for callers that need just percentiles); mean, std,
+        # min and max are then not maintained
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[~np.isnan(values)]
+        if values.size == 0:
+            return self
+
+        n_b = values.size
+        n = self.n + n_b
+        if moments:
+            # Merge the block's moments into the running ones
+            mean_b = values.mean()
+            m2_b = ((values - mean_b) ** 2).sum()
+            delta = mean_b - self.mean
+            self.mean += delta * n_b / n
+            self.m2 += m2_b + delta ** 2 * self.n * n_b / n
+            self.min = min(self.min, values.min()) if self.n else values.min()
+            self.max = max(self.max, values.max()) if self.n else values.max()
+
+        # Reservoir sampling (algorithm R), vectorized over the block
+        fill = min(max(self.sample_size - self.n, 0), n_b)
+        self._reservoir[self.n:self.n + fill] = values[:fill]
+        if fill < n_b:
+            positions = np.arange(self.n + fill, n) + 1
+            slots = (self._rng.random(positions.size) * positions).astype(np.int64)
+            take = slots < self.sample_size
+            self._reservoir[slots[take]] = values[fill:][take]
+
+        self.n = n
+        return self
+
+    def percentile(self, q):
+        """
+        Returns the q-th percentile (0-100) of the values seen, from the reservoir sample (NaN if none).
+        """
+        if self.n == 0:
+            return np.nan
+        return np.percentile(self._reservoir[:min(self.n, self.sample_size)], q)
+
+    def summary(self):
+        """
+        Returns a dict with keys ['mean', 'median', 'std', 'min', 'max'] (std with ddof=1, like pandas).
+        """
+        if self.n == 0:
+            return {'mean': np.nan, 'median': np.nan, 'std': np.nan, 'min': np.nan, 'max': np.nan}
+        sample = self._reservoir[:min(self.n, self.sample_size)]
+        return {
+            'mean': self.mean,
+            'median': np.median(sample),
+            'std': np.sqrt(self.m2 / (self.n - 1)) if self.n > 1 else np.nan,
+            'min': self.min,
+            'max': self.max
+        }
+
+
+
+class Loader:
+    """
+    Opens NetCDF files lazily with explicit time chunks, keeping only the requested variables.
+
+    Datasets returned by Loader stay lazy until a Plotter/Processor call touches a variable, and only
+    the variables a call needs are read. Diurnal statistics are accumulated chunk by chunk, so their peak
+    memory is bounded by the chunk size rather than by the length of the record. Averaged series are
+    resampled chunk by chunk against the decoded time axis (held once per dataset); unaveraged series
+    are whole pandas Series and hold the full variable.
+    """
+    def __init__(self, time_chunk=1440):
+        # time_chunk: number of time steps per chunk (default 1 day of 1-minute data)
+        self.time_chunk = time_chunk
+
+    def open(self, path, variables=None, time_var='time'):
+        """
+        Lazily opens one NetCDF file, or several (a glob pattern or a list) concatenated along time.
+
+        Parameters:
+        - path: File path, glob pattern (e.g. '.../planelog_concat_*.nc') or list of file paths.
+        - variables: Optional list of variables to keep; all others are dropped before any data is read.
+        - time_var: Name of the time variable, used to find the dimension to chunk along.
+
+        Returns:
+        - dataset: xarray Dataset backed by lazy (dask, if installed) arrays.
+        """
+        paths = sorted(glob.glob(path)) if isinstance(path, str) and glob.has_magic(path) else path
+        keep = None
+        if variables is not None:
+            keep = list(variables) + [time_var] if time_var not in variables else list(variables)
+
+        if isinstance(paths, str):
+            dataset = xr.open_dataset(paths)
+        else:
+            if dask is None:
+                raise ImportError('Opening multiple files lazily requires dask')
+            # Peek at the first file to find the time dimension to concatenate along
+            with xr.open_dataset(paths[0]) as first:
+                time_dim = first[time_var].dims[0]
+            # Subset each file before combining, so variables with irregular dims (e.g. MAPL
+            # bookkeeping variables in GEOS-Chem output) never reach the concatenation
+            preprocess = functools.partial(_keep_variables, keep=keep) if keep is not None else None
+            dataset = xr.open_mfdataset(paths, combine='nested', concat_dim=time_dim, data_vars='minimal',
+                                        coords='minimal', compat='override', chunks={time_dim: self.time_chunk},
+                                        preprocess=preprocess)
+
+        if keep is not None:
+            dataset = _keep_variables(dataset, keep)
+
+        if dask is not None:
+            dataset = dataset.chunk({dataset[time_var].dims[0]: self.time_chunk})
+
+        # Remember the source files (subsetting and chunking drop the backend's own 'source')
+        dataset.encoding['sources'] = [paths] if isinstance(paths, str) else list(paths)
+        return dataset
+
+
 
 class Plotter:
-    def __init__(self):
-        pass
-    
+    def __init__(self, cache=None, manifest=None, headless=False, verbose=False):
+        self.cache = cache if cache is not None else series_cache
+        self.processor = Processor(cache=self.cache)
+        # Optional render_utils.BuildManifest; saved figures that are up to date are then skipped, their
+        # paths appended to self.skipped (and printed with verbose=True)
+        self.manifest = manifest
+        self.skipped = []
+        self.verbose = verbose
+        # Headless mode draws on pyplot-less Agg figures (one per figure kind, cleared and reused for every
+        # plot) and never calls plt.show(); figures without a save path are rendered to in-memory PNG
+        # buffers appended to self.buffers as (name, io.BytesIO) pairs, to be drained by the caller
+        self.headless = headless
+        self.buffers = []
+        self._figures = {}
+
+    def __getstate__(self):
+        # Reusable figures stay with the process that drew them (e.g. when sent to a render worker)
+        state = self.__dict__.copy()
+        state['_figures'] = {}
+        return state
+
+    def _new_figure(self, kind, figsize):
+        if not self.headless:
+            return plt.figure(figsize=figsize)
+
+        fig = self._figures.get(kind)
+        if fig is None:
+            fig = Figure(figsize=figsize)
+            FigureCanvasAgg(fig)
+            self._figures[kind] = fig
+        return fig
+
+    def _finish_figure(self, fig, name, fig_save_path):
+        # Saves to a path or file-like object; without one, shows the figure (or, headless, renders it to a buffer)
+        if fig_save_path is None and self.headless:
+            fig_save_path = io.BytesIO()
+            self.buffers.append((name, fig_save_path))
+
+        if fig_save_path is not None:
+            with instrument.stage('savefig'):
+                fig.savefig(fig_save_path, dpi=300, bbox_inches='tight', format=None if isinstance(fig_save_path, str) else 'png')
+            if isinstance(fig_save_path, io.IOBase):
+                fig_save_path.seek(0)
+        else:
+            plt.show()
 
+        # Release the artists: a reused headless figure is cleared, a pyplot figure is closed
+        if self.headless:
+            fig.clear()
+        else:
+            plt.close(fig)
+
+
+    @instrument.timed()
     def plot_diurnal_variation(self, dataset, variable_name, scale_factor=1, time_var='time', local_offset=0, ylabel=None, p_color='blue',
                                second_dataset=None, second_variable_name=None, second_scale_factor=1, second_time_var='time_UTC', second_ylabel=None, second_p_color='red',
                                primary_ylim=None, secondary_ylim=None, fig_save_path=None):
@@ -13,17 +427,115 @@ class Plotter:
         Plots the diurnal variation of a specified variable from an xarray dataset.
         Optionally plots a second dataset on a secondary y-axis.
         """
-        # Primary dataset processing
-        time = pd.to_datetime(dataset[time_var].values) + pd.to_timedelta(local_offset, unit='h')
-        data = dataset[variable_name].values * scale_factor
-    
-        df = pd.DataFrame({'time': time, variable_name: data})
-        df['hour'] = df['time'].dt.hour
-        diurnal_stats = df.groupby('hour')[variable_name].mean()
-    
+        self.plot_diurnal_variations(dataset, [variable_name], scale_factor=scale_factor, time_var=time_var, local_offset=local_offset,
+                                     ylabel=ylabel, p_color=p_color, second_dataset=second_dataset,
+                                     second_variable_names=[second_variable_name], second_scale_factor=second_scale_factor,
+                                     second_time_var=second_time_var, second_ylabel=second_ylabel, second_p_color=second_p_color,
+                                     primary_ylim=primary_ylim, secondary_ylim=secondary_ylim,
+                                     fig_save_path={variable_name: fig_save_path})
+
+
+    @instrument.timed()
+    def plot_diurnal_variations(self, dataset, variable_names, scale_factor=1, time_var='time', local_offset=0, ylabel=None, p_color='blue',
+                                second_dataset=None, second_variable_names=None, second_scale_factor=1, second_time_var='time_UTC', second_ylabel=None, second_p_color='red',
+                                primary_ylim=None, secondary_ylim=None, fig_save_path=None):
+        """
+        Plots the diurnal variation of many variables, one figure per variable, computing the
+        hourly statistics of every variable in a single pass per dataset (see Processor.get_diurnal_stats).
+
+        Parameters:
+        - variable_names: List of variables to plot from dataset.
+        - second_variable_names: Optional list, paired with variable_names, of variables from second_dataset
+          to plot on a secondary y-axis (None entries skip the second axis for that figure).
+        - scale_factor, ylabel, primary_ylim, second_scale_factor, second_ylabel, secondary_ylim: Either a single
+          value used for every variable or a dict keyed by variable name.
+        - fig_save_path: Either a dict keyed by variable name (of paths or file-like objects), or a format string
+          containing '{variable}'. Figures without a save path are shown (headless: rendered to self.buffers).
+          If the Plotter has a manifest, saved figures whose input files and arguments are unchanged since they
+          were last recorded are skipped (see self.skipped).
+
+        Returns:
+        - diurnal_stats: dict of hourly statistics DataFrames keyed by variable name (for the figures drawn)
+        - second_diurnal_stats: the same for second_dataset (empty if not given)
+        """
+        if second_variable_names is None or second_dataset is None:
+            second_variable_names = [None] * len(variable_names)
+
+        inputs = dataset_sources(dataset) + (dataset_sources(second_dataset) if second_dataset is not None else [])
+
+        # Collect the figures to draw, skipping saved figures whose inputs and arguments are unchanged
+        figures = []
+        for variable_name, second_variable_name in zip(variable_names, second_variable_names):
+            if isinstance(fig_save_path, dict):
+                save_path = fig_save_path.get(variable_name)
+            elif fig_save_path is not None:
+                save_path = fig_save_path.format(variable=variable_name)
+            else:
+                save_path = None
+
+            options = dict(local_offset=local_offset, ylabel=_per_variable(ylabel, variable_name), p_color=p_color,
+                           primary_ylim=_per_variable(primary_ylim, variable_name), second_variable_name=second_variable_name,
+                           second_ylabel=_per_variable(second_ylabel, second_variable_name), second_p_color=second_p_color,
+                           secondary_ylim=_per_variable(secondary_ylim, second_variable_name))
+            params = dict(options, figure='diurnal_variation', variable_name=variable_name, time_var=time_var,
+                          scale_factor=_per_variable(scale_factor, variable_name), second_time_var=second_time_var,
+                          second_scale_factor=_per_variable(second_scale_factor, second_variable_name))
+
+            if isinstance(save_path, str) and self.manifest is not None and self.manifest.is_up_to_date(save_path, inputs, params):
+                self.skipped.append(save_path)
+                if self.verbose:
+                    print(f'Up to date, skipping: {save_path}')
+                continue
+            figures.append((variable_name, second_variable_name, save_path, options, params))
+
+        diurnal_stats, second_diurnal_stats = {}, {}
+        if figures:
+            diurnal_stats = self.processor.get_diurnal_stats(dataset, [figure[0] for figure in figures], scale_factor=scale_factor,
+                                                             time_var=time_var, local_offset=local_offset)
+
+        second_names = [figure[1] for figure in figures if figure[1] is not None]
+        if second_names:
+            second_diurnal_stats = self.processor.get_diurnal_stats(second_dataset, second_names, scale_factor=second_scale_factor,
+                                                                    time_var=second_time_var, local_offset=local_offset)
+
+        for variable_name, second_variable_name, save_path, options, params in figures:
+            self._draw_diurnal(diurnal_stats[variable_name], variable_name, second_stats=second_diurnal_stats.get(second_variable_name),
+                               fig_save_path=save_path, **options)
+
+            if isinstance(save_path, str) and self.manifest is not None and inputs:
+                self.manifest.record(save_path, inputs, params)
+
+        return diurnal_stats, second_diurnal_stats
+
+
+    def _draw_diurnal(self, stats, variable_name, local_offset=0, ylabel=None, p_color='blue', primary_ylim=None,
+                      second_stats=None, second_variable_name=None, second_ylabel=None, second_p_color='red', secondary_ylim=None,
+                      fig_save_path=None):
+        with instrument.stage('draw'):
+            fig = self._build_diurnal(stats, variable_name, local_offset, ylabel, p_color, primary_ylim, second_stats,
+                                      second_variable_name, second_ylabel, second_p_color, secondary_ylim)
+        instrument.count('figures')
+        self._finish_figure(fig, variable_name, fig_save_path)
+
+
+    def _build_diurnal(self, stats, variable_name, local_offset, ylabel, p_color, primary_ylim, second_stats,
+                       second_variable_name, second_ylabel, second_p_color, secondary_ylim):
+        fig = self._new_figure('diurnal', (10, 6))
+        self.draw_diurnal_on(fig.add_subplot(1, 1, 1), stats, variable_name, local_offset=local_offset, ylabel=ylabel,
+                             p_color=p_color, primary_ylim=primary_ylim, second_stats=second_stats,
+                             second_variable_name=second_variable_name, second_ylabel=second_ylabel,
+                             second_p_color=second_p_color, secondary_ylim=secondary_ylim)
+        return fig
+
+
+    def draw_diurnal_on(self, ax1, stats, variable_name, local_offset=0, ylabel=None, p_color='blue', primary_ylim=None,
+                        second_stats=None, second_variable_name=None, second_ylabel=None, second_p_color='red', secondary_ylim=None):
+        """
+        Draws a diurnal cycle (a DataFrame from Processor.get_diurnal_stats) on an existing Axes,
+        e.g. one panel of a multi-panel page. Options are as in plot_diurnal_variation.
+        """
         # Plot
-        fig, ax1 = plt.subplots(figsize=(10, 6))
-        ax1.plot(diurnal_stats.index, diurnal_stats.values, 'o-', label=variable_name, color=p_color)
+        ax1.plot(stats.index, stats['mean'].values, 'o-', label=variable_name, color=p_color)
         ax1.set_xlabel('Hour of Day (Local Time)' if local_offset != 0 else 'Hour of Day (UTC)')
         ax1.set_ylabel(ylabel if ylabel else f'{variable_name}', color=p_color)
         ax1.tick_params(axis='y', labelcolor=p_color, color=p_color)
@@ -34,16 +546,9 @@ class Plotter:
         if primary_ylim is not None:
             ax1.set_ylim(primary_ylim)
     
-        if second_dataset is not None and second_variable_name is not None:
-            time2 = pd.to_datetime(second_dataset[second_time_var].values) + pd.to_timedelta(local_offset, unit='h')
-            data2 = second_dataset[second_variable_name].values * second_scale_factor
-    
-            df2 = pd.DataFrame({'time': time2, second_variable_name: data2})
-            df2['hour'] = df2['time'].dt.hour
-            diurnal_stats2 = df2.groupby('hour')[second_variable_name].mean()
-    
+        if second_stats is not None:
             ax2 = ax1.twinx()
-            ax2.plot(diurnal_stats2.index, diurnal_stats2.values, 's-', label=second_variable_name, color=second_p_color)
+            ax2.plot(second_stats.index, second_stats['mean'].values, 's-', label=second_variable_name, color=second_p_color)
             ax2.set_ylabel(second_ylabel if second_ylabel else f'{second_variable_name}', color=second_p_color)
             ax2.tick_params(axis='y', labelcolor=second_p_color, color=second_p_color)
             ax2.spines['left'].set_color(p_color)
@@ -52,17 +557,13 @@ class Plotter:
             if secondary_ylim is not None:
                 ax2.set_ylim(secondary_ylim)
     
-        plt.title(f'{variable_name}')
-    
-        if fig_save_path is not None:
-            plt.savefig(fig_save_path, dpi=300, bbox_inches='tight')
-            plt.close(fig)  # Close the figure explicitly to prevent auto-display
-        else:
-            plt.show()
+        ax1.set_title(f'{variable_name}')
             
             
             
-    def plot_time_series(self, dataset, variable, scale_factor=1, time_var='time', local_offset=0, ylabel='Observed', average_interval=None, xlim=None, ylim=None):
+    @instrument.timed()
+    def plot_time_series(self, dataset, variable, scale_factor=1, time_var='time', local_offset=0, ylabel='Observed', average_interval=None, xlim=None, ylim=None,
+                         fig_save_path=None, decimate=False):
         """
         Creates a time series plot from the given dataset, with optional averaging.
     
@@ -74,47 +575,104 @@ class Plotter:
         - local_offset: Time zone offset in hours to apply to the time variable.
         - ylabel: Label for the y-axis.
         - average_interval: Pandas offset string (e.g., '10min', '1H') for averaging (optional).
+        - fig_save_path: Path or file-like object to save the figure to (optional). If None, the figure is shown
+          (headless: rendered to self.buffers).
+        - decimate: Draw only the min and max of each pixel column of the (xlim-limited) plot instead of every
+          point; peaks and the envelope of the line are unchanged. True uses one column per pixel of the saved
+          figure; an integer sets the number of columns.
         """
-        import pandas as pd
-        import matplotlib.pyplot as plt
-    
-        # Extract time and variable, apply scale factor
-        time = pd.to_datetime(dataset[time_var].values) + pd.to_timedelta(local_offset, unit='h')
-        data = dataset[variable].values * scale_factor
-    
-        # Create a pandas Series for easy resampling if averaging is requested
-        series = pd.Series(data, index=time)
-    
-        if average_interval:
-            # Resample and average
-            series = series.resample(average_interval).mean()
+        # Extract time and variable, apply scale factor and optional averaging (cached across calls)
+        series = self.cache.get_series(dataset, variable, time_var=time_var, local_offset=local_offset,
+                                       scale_factor=scale_factor, average_interval=average_interval)
     
+        self._draw_time_series(series, variable, ylabel=ylabel, average_interval=average_interval, xlim=xlim, ylim=ylim,
+                               fig_save_path=fig_save_path, decimate=decimate)
+
+
+    @instrument.timed()
+    def plot_time_series_windows(self, dataset, variable, windows, scale_factor=1, time_var='time', local_offset=0, ylabel='Observed',
+                                 average_interval=None, ylim=None, merge=True, fig_save_path=None, decimate=False):
+        """
+        Creates one time series plot per (start, end) window, reading only the samples inside each window.
+
+        The shifted time index is binary-searched (searchsorted) for each window, so only the window's
+        slice of the variable is materialized and resampled. Overlapping windows (e.g. +/-12 h around
+        neighbouring peaks) are merged first so they are read and drawn once.
+
+        Parameters:
+        - dataset, variable, scale_factor, time_var, local_offset, ylabel, average_interval, ylim, decimate: As in plot_time_series.
+        - windows: Iterable of (start, end) tuples, e.g. from Processor.get_xlim_from_peaks.
+        - merge: Merge overlapping windows before plotting (default True).
+        - fig_save_path: Optional format string for saving each window's figure, with fields
+          '{variable}', '{start}' and '{end}' (e.g. 'ClNO2_peak_{start:%Y%m%d_%H%M}.png'). If None, figures are shown
+          (headless: rendered to self.buffers).
+
+        Returns:
+        - windows: The list of (start, end) windows that were plotted.
+        """
+        windows = self.processor.merge_windows(windows) if merge else [(pd.to_datetime(a), pd.to_datetime(b)) for a, b in windows]
+
+        for start, end in windows:
+            series = self.processor.get_window_series(dataset, variable, start, end, scale_factor=scale_factor, time_var=time_var,
+                                                      local_offset=local_offset, average_interval=average_interval)
+            save_path = fig_save_path.format(variable=variable, start=start, end=end) if fig_save_path else None
+            self._draw_time_series(series, variable, ylabel=ylabel, average_interval=average_interval, xlim=(start, end), ylim=ylim,
+                                   fig_save_path=save_path, decimate=decimate)
+
+        return windows
+
+
+    def _draw_time_series(self, series, variable, ylabel='Observed', average_interval=None, xlim=None, ylim=None, fig_save_path=None,
+                          decimate=False):
+        with instrument.stage('draw'):
+            fig = self._new_figure('time_series', (12, 6))
+            self.draw_time_series_on(fig.add_subplot(1, 1, 1), series, variable, ylabel=ylabel, average_interval=average_interval,
+                                     xlim=xlim, ylim=ylim, decimate=decimate)
+            fig.tight_layout()
+        instrument.count('figures')
+        self._finish_figure(fig, variable, fig_save_path)
+
+
+    def draw_time_series_on(self, ax, series, variable, ylabel='Observed', average_interval=None, xlim=None, ylim=None, decimate=False):
+        """
+        Draws a time series (a pandas Series indexed by time) on an existing Axes, e.g. one panel of a
+        multi-panel page. Options are as in plot_time_series; with decimate=True, one bucket per pixel
+        column of a 12-inch-wide figure saved at 300 dpi is used.
+        """
+        time, values = series.index, series.values
+        if decimate and series.index.is_monotonic_increasing:
+            n_buckets = 12 * 300 if decimate is True else int(decimate)
+            with instrument.stage('decimate'):
+                time, values = _decimate_minmax(time, values, n_buckets, xlim=xlim)
+
         # Create the plot
-        plt.figure(figsize=(12, 6))
-        plt.plot(series.index, series.values, label=variable, color='tab:blue')
+        ax.plot(time, values, label=variable, color='tab:blue')
         
-        # Apply x-axis limits if provided
+        # Apply axis limits if provided
         if xlim:
-            plt.xlim(pd.to_datetime(xlim[0]), pd.to_datetime(xlim[1]))
+            ax.set_xlim(pd.to_datetime(xlim[0]), pd.to_datetime(xlim[1]))
             
         if ylim:
-            plt.ylim(pd.to_datetime(ylim[0]), pd.to_datetime(ylim[1]))
+            ax.set_ylim(ylim[0], ylim[1])
             
-        plt.xlabel('Time')
-        plt.ylabel(ylabel)
-        plt.title(f'Time Series of {variable}' + (f' (Averaged: {average_interval})' if average_interval else ''))
-        plt.grid(True)
-        plt.legend()
-        plt.tight_layout()
-        plt.show()
+        ax.set_xlabel('Time')
+        ax.set_ylabel(ylabel)
+        ax.set_title(f'Time Series of {variable}' + (f' (Averaged: {average_interval})' if average_interval else ''))
+        ax.grid(True)
+        ax.legend()
         
         
         
 class Processor:
-    def __init__(self):
-        pass
+    def __init__(self, cache=None, max_block_bytes=256 * 2**20, stats_block_size=2**20):
+        self.cache = cache if cache is not None else series_cache
+        # Number of samples fed to the summary-statistics kernel at a time
+        self.stats_block_size = stats_block_size
+        # Upper bound on the variable x time block built for lazily loaded datasets
+        self.max_block_bytes = max_block_bytes
 
-    def get_peak_n_values(self, dataset, var_name, average_interval=None, n=5, time_var='time', local_offset=0):
+    @instrument.timed()
+    def get_peak_n_values(self, dataset, var_name, average_interval=None, n=5, time_var='time', local_offset=0, min_separation=None):
         """
         Returns a DataFrame of the top n highest points (time and value) of a variable in the dataset,
         optionally averaging by a specified pandas offset string interval.
@@ -127,46 +685,422 @@ class Processor:
         - n: Number of top points to return (default 5).
         - time_var: Name of the time coordinate variable (default 'time').
         - local_offset: Timezone offset in hours to apply to the time coordinate (default 0).
+        - min_separation: pandas timedelta string (e.g. '24h'). If given, the top n points are the maxima of
+          n distinct events at least this far apart, instead of the n largest points overall.
 
         Returns:
         - summary_stats: dict with keys ['mean', 'median', 'std', 'min', 'max'] for the entire data
+          (the median is exact up to StreamingStats.sample_size points and approximate beyond that)
         - top_n_df: pandas DataFrame with columns ['time', 'value'] for the top n points
         """
-        # Convert time coordinate to pandas datetime with local offset
-        time = pd.to_datetime(dataset[time_var].values) + pd.to_timedelta(local_offset, unit='h')
-        data = dataset[var_name].values
-
-        # Create pandas Series for easy resampling and handling time index
-        series = pd.Series(data, index=time)
+        # Time-shifted (and optionally resampled) series, shared with Plotter through the cache
+        series = self.cache.get_series(dataset, var_name, time_var=time_var, local_offset=local_offset,
+                                       average_interval=average_interval)
 
         if average_interval:
-            # Resample with mean, ignoring NaNs where possible
-            series = series.resample(average_interval).mean().dropna()
-
-        # Compute summary statistics on the whole series
-        summary_stats = {
-            'mean': series.mean(),
-            'median': series.median(),
-            'std': series.std(),
-            'min': series.min(),
-            'max': series.max()
-        }
+            # Drop empty resampling bins
+            series = series.dropna()
+
+        # Compute summary statistics on the whole series in one streaming pass
+        values = series.values
+        kernel = StreamingStats()
+        for i0 in range(0, len(values), self.stats_block_size):
+            kernel.update(values[i0:i0 + self.stats_block_size])
+        summary_stats = kernel.summary()
 
-        # Get top n values and corresponding times
-        top_n = series.nlargest(n)
-        top_n_df = pd.DataFrame({'time': top_n.index, 'value': top_n.values}).reset_index(drop=True)
+        # Get top n values (or top n distinct events) and corresponding times
+        top_idx = self._top_event_indices(series.index, values, n, min_separation)
+        top_n_df = pd.DataFrame({'time': series.index[top_idx], 'value': values[top_idx]}).reset_index(drop=True)
 
         return summary_stats, top_n_df
-    
-    
+
+
+    def _top_event_indices(self, time, values, n, min_separation=None):
+        """
+        Returns the indices of the n largest values, in descending order. With min_separation, each returned
+        value is the maximum of a distinct event: no two returned times are closer than min_separation.
+        """
+        ranked = np.where(np.isnan(values), -np.inf, values)
+        n_valid = int(np.count_nonzero(~np.isnan(values)))
+        n = min(n, n_valid)
+        if n == 0:
+            return np.array([], dtype=int)
+
+        separation = pd.to_timedelta(min_separation).to_timedelta64() if min_separation is not None else None
+        times = np.asarray(time, dtype='datetime64[ns]')
+
+        # Start from a small candidate pool and widen it until n distinct events are found
+        pool = n if separation is None else min(n_valid, 8 * n)
+        while True:
+            candidates = np.argpartition(-ranked, pool - 1)[:pool]
+            candidates = candidates[np.argsort(-ranked[candidates], kind='stable')]
+            if separation is None:
+                return candidates[:n]
+
+            # Greedy suppression: keep the highest remaining candidate and drop every candidate within
+            # min_separation of it (vectorized over the pool; at most n iterations)
+            alive = np.ones(len(candidates), dtype=bool)
+            keep = []
+            cand_times = times[candidates]
+            while len(keep) < n and alive.any():
+                first = np.argmax(alive)
+                keep.append(candidates[first])
+                alive &= np.abs(cand_times - cand_times[first]) >= separation
+
+            # Every valid sample is a candidate, or the pool's smallest value ranks below all kept events
+            if len(keep) == n or pool == n_valid:
+                return np.array(keep, dtype=int)
+            pool = min(n_valid, pool * 4)
+
+
+    @instrument.timed()
+    def get_diurnal_stats(self, dataset, variables, scale_factor=1, time_var='time', local_offset=0, percentiles=(25, 75),
+                          exact_percentiles=None):
+        """
+        Computes hourly (hour-of-day) statistics for many variables sharing one time axis in a single
+        vectorized pass over a 2-D variable x time block.
+
+        Lazily loaded (chunked) variables are instead streamed chunk by chunk, so memory does not grow with
+        the length of the record: counts and means are accumulated exactly, and the median and percentiles
+        come from a per-hour StreamingStats reservoir, exact while an hour has at most sample_size samples
+        (about 3 years of 1-minute data) and an unbiased approximation beyond that.
+
+        Parameters:
+        - dataset: xarray Dataset (or similar) containing time_var and the variables.
+        - variables: List of variable names (a single name is also accepted).
+        - scale_factor: Scale applied to every variable, or a dict keyed by variable name.
+        - time_var: Name of the time coordinate variable (default 'time').
+        - local_offset: Timezone offset in hours to apply to the time coordinate (default 0).
+        - percentiles: Percentiles (0-100) to compute per hour, in addition to the median.
+        - exact_percentiles: True loads chunked variables whole (a few at a time) for exact percentiles of
+          any record length; False streams even in-memory variables. None (default) streams chunked ones only.
+
+        Returns:
+        - diurnal_stats: dict keyed by variable name of DataFrames indexed by hour (0-23) with columns
+          ['mean', 'median', 'count'] plus one 'p<q>' column per percentile. Hours without valid
+          data have a count of 0 and NaN statistics.
+        """
+        if isinstance(variables, str):
+            variables = [variables]
+
+        chunked = any(_is_chunked(dataset[var]) for var in variables)
+        if exact_percentiles is False or (chunked and not exact_percentiles):
+            return self._diurnal_streamed(dataset, variables, scale_factor, time_var, local_offset, percentiles)
+
+        time = self.cache.get_time_index(dataset, time_var=time_var, local_offset=local_offset)
+        hours = np.asarray(time.hour)
+
+        # Order samples by hour once; every variable shares the same hour segments
+        order = np.argsort(hours, kind='stable')
+        hours_sorted = hours[order]
+        starts = np.searchsorted(hours_sorted, np.arange(24))
+
+        # Lazily loaded datasets are processed a few variables at a time to bound memory
+        if chunked:
+            group_size = max(1, self.max_block_bytes // (16 * max(len(order), 1)))
+        else:
+            group_size = len(variables)
+
+        diurnal_stats = {}
+        for g in range(0, len(variables), group_size):
+            group = variables[g:g + group_size]
+            block = np.empty((len(group), len(order)), dtype=float)
+            for i, var in enumerate(group):
+                scale = _per_variable(scale_factor, var, default=1)
+                values = dataset[var].values
+                instrument.add_bytes(var, values.nbytes)
+                block[i] = np.asarray(values, dtype=float)[order] * scale
+            with instrument.stage('groupby'):
+                diurnal_stats.update(self._diurnal_block_stats(block, group, hours_sorted, starts, percentiles))
+        return diurnal_stats
+
+
+    def _diurnal_streamed(self, dataset, variables, scale_factor, time_var, local_offset, percentiles):
+        # Exact per-hour counts and sums, and a bounded per-hour sample for the order statistics. Every
+        # variable is read in one compute per time chunk, and hours are decoded per chunk too, so nothing
+        # record-length is materialized
+        count = {var: np.zeros(24, dtype=np.int64) for var in variables}
+        total = {var: np.zeros(24) for var in variables}
+        samples = {var: [StreamingStats(seed=hour) for hour in range(24)] for var in variables}
+        time_values = dataset[time_var].values
+        dim = dataset[time_var].dims[0]
+        offset = pd.to_timedelta(local_offset, unit='h')
+
+        chunks = next((dataset[var].chunks[dataset[var].dims.index(dim)] for var in variables if _is_chunked(dataset[var])),
+                      (len(time_values),))
+        i0 = 0
+        for size in chunks:
+            block = dataset[variables].isel({dim: slice(i0, i0 + size)}).load()
+            with instrument.stage('groupby'):
+                block_hours = np.asarray((pd.to_datetime(time_values[i0:i0 + size]) + offset).hour)
+                order = np.argsort(block_hours, kind='stable')
+                bounds = np.searchsorted(block_hours[order], np.arange(25))
+                for var in variables:
+                    values = np.asarray(block[var].values, dtype=float).ravel()
+                    instrument.add_bytes(var, values.nbytes)
+                    values = values * _per_variable(scale_factor, var, default=1)
+                    valid = ~np.isnan(values)
+                    count[var] += np.bincount(block_hours[valid], minlength=24)
+                    total[var] += np.bincount(block_hours[valid], weights=values[valid], minlength=24)
+                    values = values[order]
+                    for hour in range(24):
+                        if bounds[hour + 1] > bounds[hour]:
+                            samples[var][hour].update(values[bounds[hour]:bounds[hour + 1]], moments=False)
+            i0 += size
+
+        diurnal_stats = {}
+        for var in variables:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                columns = {
+                    'mean': np.where(count[var] > 0, total[var] / count[var], np.nan),
+                    'median': [sample.percentile(50) for sample in samples[var]],
+                    'count': count[var],
+                }
+            for q in percentiles:
+                columns[f'p{q:g}'] = [sample.percentile(q) for sample in samples[var]]
+            diurnal_stats[var] = pd.DataFrame(columns, index=pd.RangeIndex(24, name='hour'))
+        return diurnal_stats
+
+
+    def _diurnal_block_stats(self, block, variables, hours_sorted, starts, percentiles):
+        # Counts and sums per (variable, hour) via one bincount over a flattened variable*24+hour index
+        n_vars = len(variables)
+        valid = ~np.isnan(block)
+        bins = np.arange(n_vars)[:, None] * 24 + hours_sorted[None, :]
+        count = np.bincount(bins[valid], minlength=n_vars * 24).reshape(n_vars, 24)
+        total = np.bincount(bins[valid], weights=block[valid], minlength=n_vars * 24).reshape(n_vars, 24)
+
+        # Sort values within each hour segment (NaNs sort to the end of their segment)
+        within = np.lexsort((block, np.broadcast_to(hours_sorted, block.shape)), axis=-1)
+        block = np.take_along_axis(block, within, axis=-1)
+
+        def hourly_percentile(q):
+            # Linear interpolation between order statistics, matching np.percentile's default
+            pos = starts[None, :] + np.maximum(count - 1, 0) * (q / 100.0)
+            lo = np.floor(pos).astype(int)
+            hi = np.minimum(lo + 1, starts[None, :] + np.maximum(count - 1, 0))
+            lo = np.minimum(lo, block.shape[1] - 1)
+            hi = np.minimum(hi, block.shape[1] - 1)
+            lo_vals = np.take_along_axis(block, lo, axis=-1)
+            hi_vals = np.take_along_axis(block, hi, axis=-1)
+            return np.where(count > 0, lo_vals + (hi_vals - lo_vals) * (pos - lo), np.nan)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            columns = {
+                'mean': np.where(count > 0, total / count, np.nan),
+                'median': hourly_percentile(50),
+                'count': count,
+            }
+            for q in percentiles:
+                columns[f'p{q:g}'] = hourly_percentile(q)
+
+        hour_index = pd.RangeIndex(24, name='hour')
+        return {var: pd.DataFrame({name: values[i] for name, values in columns.items()}, index=hour_index)
+                for i, var in enumerate(variables)}
+
+
+    @instrument.timed()
+    def colocate(self, obs_dataset, model_dataset, pairs, obs_time_var='time', model_time_var='time_UTC', window='1h',
+                 obs_scale_factor=1, model_scale_factor=1):
+        """
+        Colocates observations onto the model time axis and computes paired comparison statistics.
+
+        For every model time t, each observed variable is averaged over the samples in [t - window/2, t + window/2),
+        using cumulative sums and two searchsorted calls over the (sorted) observation times for all
+        variables at once, so no Python loop runs over timestamps.
+
+        Parameters:
+        - obs_dataset: Observation dataset (e.g. the NACHTT 1-minute merged file).
+        - model_dataset: Model dataset (e.g. a GEOS-Chem plane log).
+        - pairs: dict of observed variable name -> model variable name (e.g. {'ClNO2_pptv': 'ClNO2'}).
+        - obs_time_var, model_time_var: Names of the time variables in each dataset.
+        - window: pandas offset string of the averaging window centered on each model time (default '1h').
+        - obs_scale_factor, model_scale_factor: Scale applied to every variable, or a dict keyed by variable name.
+
+        Returns:
+        - paired: DataFrame indexed by model time with (observed variable, ['obs', 'model', 'n_obs']) columns
+        - stats: DataFrame indexed by observed variable with columns
+          ['n', 'obs_mean', 'model_mean', 'bias', 'normalized_bias', 'rmse', 'r']
+        """
+        obs_time = self.cache.get_time_index(obs_dataset, time_var=obs_time_var)
+        model_time = self.cache.get_time_index(model_dataset, time_var=model_time_var)
+        if not obs_time.is_monotonic_increasing:
+            raise ValueError(f"'{obs_time_var}' must be sorted in increasing order for colocation")
+
+        obs_vars, model_vars = list(pairs), list(pairs.values())
+
+        def scaled_block(dataset, variables, scale_factor):
+            block = np.empty((len(variables), dataset[variables[0]].size), dtype=float)
+            for i, var in enumerate(variables):
+                scale = _per_variable(scale_factor, var, default=1)
+                values = dataset[var].values
+                instrument.add_bytes(var, values.nbytes)
+                block[i] = np.asarray(values, dtype=float).ravel() * scale
+            return block
+
+        obs = scaled_block(obs_dataset, obs_vars, obs_scale_factor)
+        model = scaled_block(model_dataset, model_vars, model_scale_factor)
+
+        # Window sums and counts of valid observations from cumulative sums (with a leading zero column)
+        valid = ~np.isnan(obs)
+        cum_sum = np.concatenate([np.zeros((len(obs_vars), 1)), np.cumsum(np.where(valid, obs, 0), axis=1)], axis=1)
+        cum_count = np.concatenate([np.zeros((len(obs_vars), 1), dtype=int), np.cumsum(valid, axis=1)], axis=1)
+
+        half = pd.to_timedelta(window) / 2
+        i0 = obs_time.searchsorted(model_time - half, side='left')
+        i1 = obs_time.searchsorted(model_time + half, side='left')
+
+        n_obs = cum_count[:, i1] - cum_count[:, i0]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            obs_mean = np.where(n_obs > 0, (cum_sum[:, i1] - cum_sum[:, i0]) / n_obs, np.nan)
+
+        # Paired statistics over times where both sides are valid, vectorized across variables
+        both = ~np.isnan(obs_mean) & ~np.isnan(model)
+        n = both.sum(axis=1)
+        o = np.where(both, obs_mean, 0)
+        m = np.where(both, model, 0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            o_mean = o.sum(axis=1) / n
+            m_mean = m.sum(axis=1) / n
+            bias = m_mean - o_mean
+            rmse = np.sqrt(((m - o) ** 2).sum(axis=1) / n)
+            o_dev = np.where(both, obs_mean - o_mean[:, None], 0)
+            m_dev = np.where(both, model - m_mean[:, None], 0)
+            r = (o_dev * m_dev).sum(axis=1) / np.sqrt((o_dev ** 2).sum(axis=1) * (m_dev ** 2).sum(axis=1))
+
+        stats = pd.DataFrame({'n': n, 'obs_mean': o_mean, 'model_mean': m_mean, 'bias': bias,
+                              'normalized_bias': bias / o_mean, 'rmse': rmse, 'r': r},
+                             index=pd.Index(obs_vars, name='variable'))
+
+        paired = pd.concat({var: pd.DataFrame({'obs': obs_mean[i], 'model': model[i], 'n_obs': n_obs[i]}, index=model_time)
+                            for i, var in enumerate(obs_vars)}, axis=1)
+        return paired, stats
+
+
     def get_xlim_from_peaks(self, peak_times, hours_before=12, hours_after=12):
         """
         Given a DataFrame with a 'time' column, return a list of (start, end) tuples
         where start = peak_time - hours_before, end = peak_time + hours_after.
         """
         return [(t - pd.Timedelta(hours=hours_before), t + pd.Timedelta(hours=hours_after)) for t in peak_times]
-    
-    
-    
-    
-    
\ No newline at end of file
+
+
+    def merge_windows(self, windows):
+        """
+        Given an iterable of (start, end) tuples, return a time-sorted list of (start, end) tuples
+        in which overlapping or touching windows have been merged into one.
+        """
+        windows = sorted((pd.to_datetime(start), pd.to_datetime(end)) for start, end in windows)
+
+        merged = []
+        for start, end in windows:
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        return merged
+
+
+    @instrument.timed()
+    def get_window_series(self, dataset, variable, start, end, scale_factor=1, time_var='time', local_offset=0, average_interval=None):
+        """
+        Returns a pandas Series of dataset[variable] * scale_factor between start and end (inclusive, in shifted time),
+        materializing only the samples inside the window. If average_interval is given, the window is widened
+        to whole averaging bins so edge bins average the same samples as a full-record resample.
+        """
+        time = self.cache.get_time_index(dataset, time_var=time_var, local_offset=local_offset)
+        if not time.is_monotonic_increasing:
+            raise ValueError(f"'{time_var}' must be sorted in increasing order for windowed access")
+
+        start, end = pd.to_datetime(start), pd.to_datetime(end)
+        if average_interval:
+            try:
+                start = start.floor(average_interval)
+                end = end.floor(average_interval) + pd.tseries.frequencies.to_offset(average_interval)
+            except ValueError:
+                pass  # Non-fixed frequencies (e.g. 'MS') cannot be floored; use the window as given
+
+        i0 = time.searchsorted(start, side='left')
+        i1 = time.searchsorted(end, side='left' if average_interval else 'right')
+
+        if hasattr(dataset, 'isel'):
+            data = dataset[variable].isel({dataset[time_var].dims[0]: slice(i0, i1)}).values
+        else:
+            data = dataset[variable].values[i0:i1]
+        instrument.add_bytes(variable, data.nbytes)
+        series = pd.Series(data * scale_factor, index=time[i0:i1], name=variable)
+
+        if average_interval:
+            with instrument.stage('resample'):
+                series = series.resample(average_interval).mean()
+        return series
+
+
+
+class ColumnarCache:
+    """
+    On-disk columnar (Parquet) store of time-shifted, scaled and resampled variables.
+
+    The store is partitioned by source file and averaging interval, with one memory-mapped Parquet file
+    per variable and parameter set:
+        <cache_dir>/<source file>/interval=<average_interval>/<variable>-<parameter hash>.parquet
+    A BuildManifest records each file's source fingerprint and parameters, so entries are rebuilt
+    automatically when the source file or local_offset/scale_factor/average_interval change.
+    """
+    def __init__(self, cache_dir, loader=None, cache=None):
+        self.cache_dir = cache_dir
+        self.loader = loader if loader is not None else Loader()
+        self.cache = cache if cache is not None else series_cache
+        self.manifest = BuildManifest(os.path.join(cache_dir, 'manifest.json'))
+
+    def _entry(self, source, variable, time_var, local_offset, scale_factor, average_interval):
+        params = {'source': os.path.abspath(source), 'variable': variable, 'time_var': time_var,
+                  'local_offset': local_offset, 'scale_factor': scale_factor, 'average_interval': average_interval}
+        name = f'{variable}-{self.manifest.params_hash(params)[:12]}.parquet'
+        path = os.path.join(self.cache_dir, os.path.basename(source), f'interval={average_interval or "raw"}', name)
+        return path, params
+
+    def open(self, source, variables, time_var='time', local_offset=0, scale_factor=1, average_interval=None):
+        """
+        Returns a DataFrame with a time_var column (shifted time) and one column per variable (scaled and,
+        if average_interval is given, resampled), read from the store when it is up to date and exported
+        from the source file otherwise.
+
+        The result is already shifted, scaled and averaged, so pass it to Plotter/Processor with the
+        default local_offset=0 and no average_interval.
+
+        Parameters:
+        - source: Path of the raw NetCDF file.
+        - variables: List of variable names.
+        - time_var, local_offset, average_interval: As in Plotter/Processor.
+        - scale_factor: Scale applied to every variable, or a dict keyed by variable name.
+        """
+        if isinstance(variables, str):
+            variables = [variables]
+
+        columns = {}
+        stale = []
+        for var in variables:
+            scale = _per_variable(scale_factor, var, default=1)
+            path, params = self._entry(source, var, time_var, local_offset, scale, average_interval)
+            if self.manifest.is_up_to_date(path, [source], params):
+                columns[var] = pd.read_parquet(path, memory_map=True)[var]
+            else:
+                stale.append((var, scale, path, params))
+
+        if stale:
+            # Only the variables missing from the store are read from the raw file
+            dataset = self.loader.open(source, variables=[var for var, _, _, _ in stale], time_var=time_var)
+            for var, scale, path, params in stale:
+                series = self.cache.get_series(dataset, var, time_var=time_var, local_offset=local_offset,
+                                               scale_factor=scale, average_interval=average_interval)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                series.rename(var).to_frame().to_parquet(path)
+                self.manifest.record(path, [source], params, save=False)
+                columns[var] = series.rename(var)
+            self.manifest.save()
+            dataset.close()
+
+        frame = pd.DataFrame({var: columns[var] for var in variables})
+        frame.index.name = time_var
+        return frame.reset_index()
@@ -1,19 +1,17 @@
 import os
-import xarray as xr
+import sys
 import matplotlib.pyplot as plt
 import cartopy.crs as ccrs
 import cartopy.feature as cartf
 import numpy as np
 from matplotlib.patches import Circle
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from render_utils import BuildManifest, RenderPool
+from GEOSChem_utils import aggregate_emissions, get_base_map, open_region
 
-def plot_total_dust_emissions_binary(ds, variables, bounding_box, output_png_path):
-    fig = plt.figure(figsize=(16, 12))
-    ax = plt.axes(projection=ccrs.PlateCarree())
-
-    lon_min, lon_max, lat_min, lat_max = bounding_box
-    ax.set_extent([lon_min, lon_max, lat_min, lat_max], crs=ccrs.PlateCarree())
 
+def draw_dust_background(ax):
     ax.coastlines()
     ax.add_feature(cartf.BORDERS)
     ax.add_feature(cartf.STATES, edgecolor='white', linestyle=':', linewidth=1)
@@ -31,15 +29,8 @@ def plot_total_dust_emissions_binary(ds, variables, bounding_box, output_png_pat
     gl.xlocator = plt.FixedLocator(np.arange(-180 + lon_offset, 180, 0.625))
     gl.ylocator = plt.FixedLocator(np.arange(-90 + lat_offset, 90, 0.5))
 
-    # === Emissions Mask ===
-    total_emissions = sum(ds[var].max(dim="time") for var in variables)
-    binary_mask = (total_emissions > 0).astype(int)
-
-    lon2d, lat2d = np.meshgrid(ds.lon.values, ds.lat.values)
-
-    mesh = ax.pcolormesh(lon2d, lat2d, binary_mask,
-                         cmap='gray_r', vmin=0, vmax=1, transform=ccrs.PlateCarree())
 
+def draw_dust_overlay(ax):
     # === Add red circle ===
     circle_lon = -109.7
     circle_lat = 37.18
@@ -48,31 +39,112 @@ def plot_total_dust_emissions_binary(ds, variables, bounding_box, output_png_pat
                     transform=ccrs.PlateCarree(), edgecolor='red', facecolor='none', linewidth=3)
     ax.add_patch(circle)
 
-    plt.title(f"Dust Emission Presence (DST1–DST4)\n{str(ds.time.values[0])[:13]}", fontsize=20, pad=10)
-    plt.savefig(output_png_path, bbox_inches='tight', dpi=300)
-    plt.show()
-    plt.close()
 
-# === Loop through all .nc files and generate binary emission maps ===
-folder_path = '/uufs/chpc.utah.edu/common/home/haskins-group1/data/ExtData/HEMCO/OFFLINE_DUST/v2021-08/0.5x0.625/2011/03/'
-output_folder = '/uufs/chpc.utah.edu/common/home/haskins-group1/users/jbail/GEOSChem/GEOSChem_analysis/my_scripts/dust/'
+def plot_total_dust_emissions_binary(ds, variables, bounding_box, output_png_path, title=None):
+    # === Emissions Mask ===
+    # All DST bins are reduced together as one stacked block (any bin emitting at any time)
+    binary_mask = aggregate_emissions([ds], variables)['exceedance_any'].astype(int)
+
+    # The background (features, gridlines, circle) and mesh are built once per extent and grid;
+    # each file only replaces the mask and the title
+    base_map = get_base_map(ds.lon.values, ds.lat.values, bounding_box,
+                            background=draw_dust_background, overlay=draw_dust_overlay, figsize=(16, 12),
+                            mesh_kwargs=dict(cmap='gray_r', vmin=0, vmax=1), title_kwargs=dict(fontsize=20, pad=10))
+    if title is None:
+        title = f"Dust Emission Presence (DST1–DST4)\n{str(ds.time.values[0])[:13]}"
+    base_map.update(binary_mask.values, title=title)
+    base_map.save(output_png_path, bbox_inches='tight', dpi=300)
+
+
+def render_dust_file(nc_path, output_png_path, variables, bounding_box):
+    """
+    Opens one daily HEMCO dust file and renders its binary emission map (one render-pool job).
+    Only the cells inside the bounding box are read and reduced.
+    """
+    with open_region(nc_path, bounding_box, variables=variables) as ds:
+        plot_total_dust_emissions_binary(
+            ds=ds,
+            variables=variables,
+            bounding_box=bounding_box,
+            output_png_path=output_png_path
+        )
+    return output_png_path
+
+
+def render_monthly_composite(nc_paths, output_png_path, variables, bounding_box):
+    """
+    Renders the binary emission map of a whole month of daily HEMCO dust files in one pass over the files.
+    """
+    # The next files are read on background threads while the current one is reduced
+    composite = aggregate_emissions(nc_paths, variables, bbox=bounding_box, prefetch=2)
+    base_map = get_base_map(composite.lon.values, composite.lat.values, bounding_box,
+                            background=draw_dust_background, overlay=draw_dust_overlay, figsize=(16, 12),
+                            mesh_kwargs=dict(cmap='gray_r', vmin=0, vmax=1), title_kwargs=dict(fontsize=20, pad=10))
+    base_map.update(composite['exceedance_any'].values.astype(int),
+                    title=f"Dust Emission Presence (DST1–DST4)\nMonthly composite ({len(nc_paths)} files)")
+    base_map.save(output_png_path, bbox_inches='tight', dpi=300)
+    return output_png_path
 
-emission_vars = ['EMIS_DST1', 'EMIS_DST2', 'EMIS_DST3', 'EMIS_DST4']
-bounding_box = (-130, -60, 20, 55)
 
-for filename in os.listdir(folder_path):
-    if filename.endswith('.nc'):
+def render_dust_sequence(nc_paths, output_path, variables, bounding_box, fps=4):
+    """
+    Streams the daily binary emission maps of many HEMCO dust files into one animation (.gif/.mp4)
+    or tiled contact sheet (.png), drawn on a single reused map instead of one PNG per day.
+    """
+    daily = aggregate_emissions(nc_paths, variables, period='D', bbox=bounding_box, prefetch=2)
+    base_map = get_base_map(daily.lon.values, daily.lat.values, bounding_box,
+                            background=draw_dust_background, overlay=draw_dust_overlay, figsize=(16, 12),
+                            mesh_kwargs=dict(cmap='gray_r', vmin=0, vmax=1), title_kwargs=dict(fontsize=20, pad=10))
+    frames = ((daily['exceedance_any'].sel(period=day).values.astype(int), f"Dust Emission Presence (DST1–DST4)\n{day}")
+              for day in daily.period.values)
+    base_map.save_sequence(frames, output_path, fps=fps, n_frames=daily.sizes['period'])
+    return output_path
+
+
+def main(workers=None, force=False, sequence_path=None):
+    # === Loop through all .nc files and generate binary emission maps ===
+    folder_path = '/uufs/chpc.utah.edu/common/home/haskins-group1/data/ExtData/HEMCO/OFFLINE_DUST/v2021-08/0.5x0.625/2011/03/'
+    output_folder = '/uufs/chpc.utah.edu/common/home/haskins-group1/users/jbail/GEOSChem/GEOSChem_analysis/my_scripts/dust/'
+
+    emission_vars = ['EMIS_DST1', 'EMIS_DST2', 'EMIS_DST3', 'EMIS_DST4']
+    bounding_box = (-130, -60, 20, 55)
+
+    # Skip maps whose input file and plot parameters are unchanged since they were last rendered
+    manifest = BuildManifest(os.path.join(output_folder, 'figure_manifest.json'))
+    params = {'figure': 'dust_emissions_binary', 'variables': emission_vars, 'bounding_box': bounding_box}
+
+    # Each daily map is an independent job; render them across all cores
+    pool = RenderPool(workers=workers)
+    jobs = {}
+    nc_files = [filename for filename in sorted(os.listdir(folder_path)) if filename.endswith('.nc')]
+    for filename in nc_files:
         nc_path = os.path.join(folder_path, filename)
-        print(f"Processing: {filename}")
-        try:
-            ds = xr.open_dataset(nc_path)
-            output_png_path = os.path.join(output_folder, f"{os.path.splitext(filename)[0]}_binary_emissions.png")
-            plot_total_dust_emissions_binary(
-                ds=ds,
-                variables=emission_vars,
-                bounding_box=bounding_box,
-                output_png_path=output_png_path
-            )
-            ds.close()
-        except Exception as e:
-            print(f"Failed to process {filename}: {e}")
+        output_png_path = os.path.join(output_folder, f"{os.path.splitext(filename)[0]}_binary_emissions.png")
+        if not force and manifest.is_up_to_date(output_png_path, [nc_path], params):
+            print(f"Up to date, skipping: {filename}")
+            continue
+        jobs[filename] = (nc_path, output_png_path)
+        pool.submit(render_dust_file, nc_path, output_png_path, emission_vars, bounding_box, label=filename)
+
+    # Monthly composite mask from every daily file
+    nc_paths = [os.path.join(folder_path, filename) for filename in nc_files]
+    composite_png_path = os.path.join(output_folder, 'monthly_composite_binary_emissions.png')
+    if nc_paths and (force or not manifest.is_up_to_date(composite_png_path, nc_paths, params)):
+        jobs['monthly composite'] = (nc_paths, composite_png_path)
+        pool.submit(render_monthly_composite, nc_paths, composite_png_path, emission_vars, bounding_box, label='monthly composite')
+
+    for result in pool.run():
+        if result['ok']:
+            inputs, output_png_path = jobs[result['label']]
+            manifest.record(output_png_path, inputs if isinstance(inputs, list) else [inputs], params, save=False)
+        else:
+            print(f"Failed to process {result['label']}")
+    manifest.save()
+
+    # Optionally also write every day into one animation or contact sheet (e.g. 'dust_2011_03.gif')
+    if sequence_path is not None:
+        render_dust_sequence(nc_paths, os.path.join(output_folder, sequence_path), emission_vars, bounding_box)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,48 +1,29 @@
 import os
-import xarray as xr
-import matplotlib.pyplot as plt
+import sys
 import cartopy.crs as ccrs
 import cartopy.feature as cfeature
 import numpy as np
-from datetime import datetime
 
-# Directory containing the species concentration files
-file_directory = '/uufs/chpc.utah.edu/common/home/haskins-group1/users/jbail/GEOSChem/GC_RunDirs/gc_2x25_nacht2011_base/OutputDir/'
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from render_utils import BuildManifest, RenderPool
+from GEOSChem_utils import FileCatalog, get_base_map, open_region, parse_file_time, prefetch_datasets
 
-# Create a folder for saving the figures if it doesn't exist
-output_folder = '/uufs/chpc.utah.edu/common/home/haskins-group1/users/jbail/GEOSChem/scripting/plots'
-os.makedirs(output_folder, exist_ok=True)
 
-# List all files in the directory (assumes files are in .nc4 format)
-file_list = [f for f in os.listdir(file_directory) if 'SpeciesConc' in f and f.endswith('.nc4')]
+def species_conc_output_path(file_name, species_var, output_folder):
+    """
+    Returns the PNG path for the map of species_var drawn from the SpeciesConc file file_name.
+    """
+    # Extract the date from the file name (e.g. GEOSChem.SpeciesConc.20110217_0000z.nc4)
+    formatted_date = parse_file_time(file_name).strftime('%Y-%m-%d')
 
-# Iterate through each file
-for file_name in file_list:
-    # Read the dataset
-    ds = xr.open_dataset(os.path.join(file_directory, file_name))
+    return os.path.join(output_folder, f"{formatted_date}_{species_var}.png")
 
-    # Extract the variable (modify this to match your actual variable name)
-    species_var = 'SpeciesConcVV_ClNO2'  # Replace with the appropriate variable name if needed
-    mean_data = ds[species_var].mean(dim=['time', 'lev'])
-
-    # Get the actual latitude and longitude edges from the dataset
-    lons = ds['lon'].values
-    lats = ds['lat'].values
-
-    # Create a plot with PlateCarree projection
-    fig, ax = plt.subplots(subplot_kw={'projection': ccrs.PlateCarree()})
 
+def draw_species_conc_background(ax):
     # Add geographic features
     ax.add_feature(cfeature.BORDERS, linestyle=':')
     ax.add_feature(cfeature.STATES, linestyle='-', linewidth=1)
 
-    # Plot data
-    pc = mean_data.plot(ax=ax, cmap='viridis', add_colorbar=False)
-
-    # Add a horizontal colorbar
-    cbar = plt.colorbar(pc, ax=ax, orientation='horizontal', pad=0.05)
-    cbar.set_label('ClNO2 Concentration')
-
     # Define grid lines using actual GEOS-Chem grid boundaries
     lon_lines = np.arange(-180, 180, 2.5) + 1.25  # Round to avoid floating-point precision issues
     lat_lines = np.arange(-90, 90, 2) + 1
@@ -55,18 +36,101 @@ for file_name in file_list:
     ax.set_xticklabels([])
     ax.set_yticklabels([])
 
-    ax.set_extent([-125, -70, 20, 47])  # Keep the extent as you requested
 
-    # Extract the date and species concentration from the file name (modify based on your file naming convention)
-    date_str = file_name.split('.')[2]  # Assuming date is the second part of the filename
-    date_obj = datetime.strptime(date_str, '%Y%m%d_%H%Mz')  # Adjust format as needed
-    formatted_date = date_obj.strftime('%Y-%m-%d')
+def plot_species_conc_file(file_path, species_var, output_folder):
+    """
+    Plots the time- and level-mean of species_var from one SpeciesConc file and saves it as a PNG
+    (one render-pool job). Returns the path of the saved figure.
+    """
+    file_name = os.path.basename(file_path)
+
+    # Read only the species and the cells inside the map extent
+    extent = [-125, -70, 20, 47]  # Keep the extent as you requested
+    ds = open_region(file_path, extent, variables=[species_var])
+
+    # Extract the variable (modify this to match your actual variable name)
+    mean_data = ds[species_var].mean(dim=['time', 'lev'])
+
+    # The background (features, gridlines, colorbar) and mesh are built once per grid;
+    # each file only replaces the mean field
+    base_map = get_base_map(ds['lon'].values, ds['lat'].values, extent,
+                            background=draw_species_conc_background, figsize=(6.4, 4.8), mesh_kwargs=dict(cmap='viridis'),
+                            colorbar_kwargs=dict(orientation='horizontal', pad=0.05, label='ClNO2 Concentration'), autoscale=True)
+    base_map.update(mean_data.values)
 
     # Create the output filename
-    output_file = os.path.join(output_folder, f"{formatted_date}_{species_var}.png")
+    output_file = species_conc_output_path(file_name, species_var, output_folder)
 
     # Save the plot
-    plt.savefig(output_file, dpi=300)
-    plt.close()
+    base_map.save(output_file, dpi=300)
+    ds.close()
+
+    return output_file
+
+
+def render_species_conc_sequence(file_paths, species_var, output_path, fps=4):
+    """
+    Streams the time- and level-mean maps of species_var from many SpeciesConc files into one
+    animation (.gif/.mp4) or tiled contact sheet (.png), drawn on a single reused map.
+    """
+    extent = [-125, -70, 20, 47]
+    file_paths = sorted(file_paths)
+
+    def frames():
+        # The next files are read on background threads while the current frame is drawn
+        for file_path, ds in prefetch_datasets(file_paths, variables=[species_var], bbox=extent, depth=2):
+            yield ds[species_var].mean(dim=['time', 'lev']).values, f'{parse_file_time(file_path):%Y-%m-%d}'
+
+    with open_region(file_paths[0], extent, variables=[species_var]) as ds:
+        lon, lat = ds['lon'].values, ds['lat'].values
+    base_map = get_base_map(lon, lat, extent, background=draw_species_conc_background, figsize=(6.4, 4.8),
+                            mesh_kwargs=dict(cmap='viridis'),
+                            colorbar_kwargs=dict(orientation='horizontal', pad=0.05, label='ClNO2 Concentration'), autoscale=True)
+    base_map.save_sequence(frames(), output_path, fps=fps, n_frames=len(file_paths))
+    return output_path
+
+
+def main(workers=None, force=False, sequence_path=None):
+    # Directory containing the species concentration files
+    file_directory = '/uufs/chpc.utah.edu/common/home/haskins-group1/users/jbail/GEOSChem/GC_RunDirs/gc_2x25_nacht2011_base/OutputDir/'
+
+    # Create a folder for saving the figures if it doesn't exist
+    output_folder = '/uufs/chpc.utah.edu/common/home/haskins-group1/users/jbail/GEOSChem/scripting/plots'
+    os.makedirs(output_folder, exist_ok=True)
+
+    # SpeciesConc files from the run's catalog (only files added or changed since the last run are opened)
+    catalog = FileCatalog(os.path.join(output_folder, 'catalog.json'), verbose=True)
+    catalog.update(file_directory, patterns=('*.nc4',))
+    file_paths = catalog.query('SpeciesConc')
+
+    species_var = 'SpeciesConcVV_ClNO2'  # Replace with the appropriate variable name if needed
 
-    print(f"Saved plot for {file_name} to {output_file}")
+    # Skip maps whose input file and plot parameters are unchanged since they were last rendered
+    manifest = BuildManifest(os.path.join(output_folder, 'figure_manifest.json'))
+    params = {'figure': 'species_conc_mean', 'species_var': species_var}
+
+    # Each file is an independent figure job; render them across all cores
+    pool = RenderPool(workers=workers)
+    sources = {}
+    for file_path in file_paths:
+        file_name = os.path.basename(file_path)
+        sources[file_name] = file_path
+        if not force and manifest.is_up_to_date(species_conc_output_path(file_name, species_var, output_folder), [file_path], params):
+            print(f"Up to date, skipping: {file_name}")
+            continue
+        pool.submit(plot_species_conc_file, file_path, species_var, output_folder, label=file_name)
+
+    for result in pool.run():
+        if result['ok']:
+            manifest.record(result['result'], [sources[result['label']]], params, save=False)
+            print(f"Saved plot for {result['label']} to {result['result']}")
+    manifest.save()
+
+    # Optionally also write every file into one animation or contact sheet (e.g. 'ClNO2_daily.gif')
+    if sequence_path is not None:
+        render_species_conc_sequence(file_paths, species_var,
+                                     os.path.join(output_folder, sequence_path))
+
+
+if __name__ == "__main__":
+    main()
@@ -11,7 +11,7 @@ This example script creates a PDF file with 2 pages.
       O3 from the first model layer (from the "SpeciesConc"
       diagnostic collection is) plotted in blue.
 
-      O3 at 10 meter height (from the "SpeciesConc_10m"
+      O3 at 10 meter height (from the "ConcAboveSfc"
       diagnostic collection) is plotted in red.
 
    Page 2:
@@ -19,7 +19,7 @@ This example script creates a PDF file with 2 pages.
       HNO3 from the first model layer (from the SpeciesConc
       diagnostic collection is) plotted in blue.
 
-      HNO3 at 10 meter height (from the SpeciesConc_10m
+      HNO3 at 10 meter height (from the ConcAboveSfc
       diagnostic collection) is plotted in red.
 
 You can of course modify this for your own particular applications.
@@ -32,15 +32,17 @@ yantosca@seas.harvard.edu
 '''
 
 # Imports
-import gcpy.constants as gcon
 import os
 import numpy as np
 import matplotlib.dates as mdates
 import matplotlib.ticker as mticker
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_pdf import PdfPages
-import xarray as xr
 import warnings
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from GEOSChem_utils import load_site_table
 
 # Tell matplotlib not to look for an X-window, as we are plotting to
 # a file and not to the screen.  This will avoid some warning messages.
@@ -51,164 +53,36 @@ warnings.filterwarnings('ignore', category=RuntimeWarning)
 warnings.filterwarnings('ignore', category=UserWarning)
 
 
-def find_files_in_dir(path, substrs):
-    '''
-    Returns a list of all files in a directory that match one or more
-    substrings.
-    
-    Args:
-    -----
-       path : str
-          Path to the directory in which to search for files.
-    
-       substrs : list of str
-          List of substrings used in the search for files.
-    
-    Returns:
-    --------
-       file_list : list of str
-          List of files in the directory (specified by path)
-          that match all substrings (specified in substrs).
-    '''
-    
-    # Initialize
-    file_list = []
-    
-    # Walk through the given data directory.  Then for each file found,
-    # add it to file_list if it matches text in search_list.
-    for root, directory, files in os.walk(path):
-       for f in files:
-          for s in substrs:
-             if s in f:
-                file_list.append(os.path.join(root, f))
-    
-    # Return an alphabetically sorted list of files
-    file_list.sort()
-    return file_list
-
-
-def find_value_index(seq, val):
-    '''
-    Finds the index of a numpy array that is close to a value.
-    
-    Args:
-    -----
-      seq : numpy ndarray
-        An array of numeric values.
-    
-      val : number
-        The value to search for in seq.
-    
-    Returns:
-    --------
-      result : integer
-        The index of seq that has a value closest to val.
-    
-    Remarks:
-    --------
-    This algorithm was found on this page:
-    https://stackoverflow.com/questions/48900977/find-all-indexes-of-a-numpy-array-closest-to-a-value
-    '''
-    r = np.where(np.diff(np.sign(seq - val)) != 0)
-    idx = r + (val - seq[r]) / (seq[r + np.ones_like(r)] - seq[r])
-    idx = np.append(idx, np.where(seq == val))
-    idx = np.sort(idx)
-    result = np.round(idx)
-    
-    # NOTE: xarray needs integer values, so convert here!
-    return int(result[0])
-
-
-def read_geoschem_data(path, collections):
-    '''
-    Returns an xarray Dataset containing timeseries data.
-    
-    Args:
-    -----
-      path : str
-        Directory path where GEOS-Chem diagnostic output
-        files may be found.
-    
-      collections: list of str
-        List of GEOS-Chem collections.  Files for these
-        collections will be read into the xarray Dataset.
-    
-    Returns:
-    --------
-      ds : xarray Dataset
-        A Dataset object containing the GEOS-Chem diagnostic
-        output corresponding to the collections that were
-        specified.
-    '''
-    
-    # Get a list of variables that GCPy should not read.
-    # These are mostly variables introduced into GCHP with the MAPL v1.0.0
-    # update.  These variables contain either repeated or non-standard
-    # dimensions that can cause problems in xarray when combining datasets.
-    skip_vars = gcon.skip_these_vars
-    
-    # Find all files in the given
-    file_list = find_files_in_dir(path, collections)
-    
-    # Return a single xarray Dataset containing data from all files
-    # NOTE: Need to add combine="nested" for xarray 0.15 and higher
-    v = xr.__version__.split(".")
-    if int(v[0]) == 0 and int(v[1]) >= 15:
-      return xr.open_mfdataset(file_list,
-                    drop_variables=skip_vars,
-                    combine="nested",
-                    concat_dim=None)
-    else:
-      return xr.open_mfdataset(file_list,
-                    drop_variables=skip_vars)
-
-
-def plot_timeseries_data(ds, site_coords):
+def plot_timeseries_data(table, site):
     '''
-    Plots a timseries of data at a given (lat,lon) location.
+    Plots a timseries of data at a given site.
     
     Args:
     -----
-      ds : xarray Dataset
-        Dataset containing GEOS-Chem timeseries data.
+      table : pandas DataFrame
+        Site table from GEOSChem_utils.load_site_table, indexed by
+        (site, time), with concentrations already in ppbv.
     
-      site_coords : tuple
-        Contains the coordinate (lat, lon) of a site location
-        at which the timeseries data will be plotted.
+      site : str
+        Name of the site (in the table) to plot.
     '''
     
     # ----------------------------------------------------------------------
-    # Get the GEOS-Chem data for O3 and HNO3 corresponding to the
-    # location of the observational station.  We will save these into
-    # xarray DataArray objects, which we'll need for plotting.
+    # Get the GEOS-Chem data for O3 and HNO3 at the observational station.
+    # The table already holds every species at the site's grid cell
+    # (level 1 for 3-D species, ~60m height), converted to ppbv.
     #
     # YOU CAN EDIT THIS FOR YOUR OWN PARTICULAR APPLICATION!
     # ----------------------------------------------------------------------
+    site_table = table.loc[site]
     
-    # Find the indices corresponding to the site lon and lat
-    lat_idx = find_value_index(ds.lat.values, site_coords[0])
-    lon_idx = find_value_index(ds.lon.values, site_coords[1])
-    
-    # Save O3 from the first level (~60m height) (ppb) into a DataArray
-    ## added the vv. I THINK I NEED TO MODIFY CODE TO NOT BE 10M OR WHATEVER
-    O3_L1 = ds['SpeciesConcVV_O3'].isel(lon=lon_idx, lat=lat_idx, lev=0)
-    O3_L1 *= 1.0e9
-    O3_L1.attrs['units'] = 'ppbv'
+    # O3 from the first level (~60m height) and at 10m height (ppbv)
+    O3_L1 = site_table['SpeciesConcVV_O3']
+    O3_10m = site_table['SpeciesConc10m_O3']
     
-    # Save O3 @ 10m height into a DataArray
-    O3_10m = ds['SpeciesConc10m_O3'].isel(lon=lon_idx, lat=lat_idx)
-    O3_10m *= 1.0e9
-    O3_10m.attrs['units'] = 'ppbv'
-    
-    # Save HNO3 from the first level (~60m height) into a DataArray
-    HNO3_L1 = ds['SpeciesConc_HNO3'].isel(lon=lon_idx, lat=lat_idx, lev=0)
-    HNO3_L1 *= 1.0e9
-    HNO3_L1.attrs['units'] = 'ppbv'
-    
-    # Save HNO3 @ 10m height into a DataArray
-    HNO3_10m = ds['SpeciesConc10m_HNO3'].isel(lon=lon_idx, lat=lat_idx)
-    HNO3_10m *= 1.0e9
-    HNO3_10m.attrs['units'] = 'ppbv'
+    # HNO3 from the first level (~60m height) and at 10m height (ppbv)
+    HNO3_L1 = site_table['SpeciesConc_HNO3']
+    HNO3_10m = site_table['SpeciesConc10m_HNO3']
     
     # ----------------------------------------------------------------------
     # Create a PDF file of the plots
@@ -216,7 +90,7 @@ def plot_timeseries_data(ds, site_coords):
     
     # Get min & max days of the plot span (for setting the X-axis range).
     # To better center the plot, add a cushion of 12 hours on either end.
-    time = ds['time'].values
+    time = site_table.index.values
     datemin = np.datetime64(time[0]) - np.timedelta64(12, 'h')
     datemax = np.datetime64(time[-1]) + np.timedelta64(12, 'h')
     
@@ -235,12 +109,12 @@ def plot_timeseries_data(ds, site_coords):
       if i == 0:
     
         # 1st model level
-        O3_L1.plot.line(ax=ax0, x='time', color='blue',
+        ax0.plot(O3_L1.index, O3_L1.values, color='blue',
                  marker='o', label='O3 from 1st model level',
                  linestyle='-')
     
         # 10 mheight
-        O3_10m.plot.line(ax=ax0, x='time', color='red',
+        ax0.plot(O3_10m.index, O3_10m.values, color='red',
                   marker='x', label='O3 at 10m height',
                   linestyle='-')
     
@@ -259,12 +133,12 @@ def plot_timeseries_data(ds, site_coords):
       if i == 1:
     
         # 1st model level
-        HNO3_L1.plot.line(ax=ax0, x='time', color='blue',
+        ax0.plot(HNO3_L1.index, HNO3_L1.values, color='blue',
                    marker='o', label='HNO3 from 1st model level',
                    linestyle='-')
     
         # 10m height
-        HNO3_10m.plot.line(ax=ax0, x='time', color='red',
+        ax0.plot(HNO3_10m.index, HNO3_10m.values, color='red',
                     marker='x', label='HNO3 at 10m height',
                     linestyle='-')
     
@@ -327,17 +201,20 @@ def main():
     # (YOU MUST EDIT THIS FOR YUR OWN PARTICULAR APPLICATION!)
     path_to_data = '/uufs/chpc.utah.edu/common/home/haskins-group1/users/jbail/GEOSChem/GC_RunDirs/gc_2x25_nacht2011_base/OutputDir'
     
-    # Get a list of files in the ConcAboveSfc and SpeciesConc collections
+    # Variables to read from the SpeciesConc and ConcAboveSfc collections
     # (YOU CAN EDIT THIS FOR YOUR OWN PARTICULAR APPLICATION!)
-    collections = ['SpeciesConc']
+    variables = {
+        'SpeciesConc': ['SpeciesConcVV_O3', 'SpeciesConc_HNO3'],
+        'ConcAboveSfc': ['SpeciesConc10m_O3', 'SpeciesConc10m_HNO3'],
+    }
     
-    # Read GEOS-Chem data into an xarray Dataset
-    ds = read_geoschem_data(path_to_data, collections)
-    
-    # Plot timeseries data at Centerville, AL (32.94N, 87.18W)
+    # Plot timeseries data at the site (40.05N, 105.01W)
     # (YOU CAN EDIT THIS FOR YOUR OWN PARTICULAR APPLICATION!)
-    site_coords = (40.05, -105.01)
-    plot_timeseries_data(ds, site_coords)
+    sites = {'site': (40.05, -105.01)}
+    
+    # Read only those variables at the site's grid cell (level 1), in ppbv
+    table = load_site_table(path_to_data, variables, sites, lev=0, scale_factor=1.0e9, units='ppbv')
+    plot_timeseries_data(table, 'site')
 
 
 if __name__ == "__main__":
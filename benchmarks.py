@@ -0,0 +1,339 @@
+"""
+Benchmarks for the Plotter/Processor hot paths and the GEOS-Chem SpeciesConc utilities.
+
+Synthetic NACHTT-shaped datasets (1-minute samples with NaN gaps) and SpeciesConc grids are written
+to a temporary directory. Each stage (load, time conversion, aggregation, peaks, render, savefig) is
+timed separately, and the peak memory allocated during the stage is recorded. Results are written as
+JSON, and can be compared with a previous run to catch regressions:
+
+    python benchmarks.py --months 1 6 --variables 1 10 --output bench_new.json
+    python benchmarks.py --output bench_new.json --compare bench_old.json
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib.figure import Figure
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from NACHTT_utils import Loader, Plotter, Processor, SeriesCache
+
+
+class StageTimer:
+    """
+    Times named stages and records the peak memory traced while each one runs.
+
+    Time spent in Figure.savefig is recorded separately from the stage that calls it, so a plotting
+    call is split into 'render' (building and drawing the figure) and 'savefig' (rasterizing and
+    writing the file).
+    """
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.stages = {}
+        self._savefig_seconds = 0.0
+        self._savefig_count = 0
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if self.trace_memory:
+            tracemalloc.start()
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1] if self.trace_memory else None
+            if self.trace_memory:
+                tracemalloc.stop()
+            self._add(name, seconds, peak)
+
+    @contextlib.contextmanager
+    def render_stage(self, render_name='render', savefig_name='savefig'):
+        """
+        Times a plotting call, splitting the time spent inside Figure.savefig into its own stage.
+        """
+        original = Figure.savefig
+        timer = self
+
+        def timed_savefig(fig, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return original(fig, *args, **kwargs)
+            finally:
+                timer._savefig_seconds += time.perf_counter() - start
+                timer._savefig_count += 1
+
+        self._savefig_seconds, self._savefig_count = 0.0, 0
+        Figure.savefig = timed_savefig
+        try:
+            with self.stage(render_name):
+                yield
+        finally:
+            Figure.savefig = original
+
+        # The savefig time was measured inside the render stage; move it to its own stage
+        self.stages[render_name]['seconds'] -= self._savefig_seconds
+        self._add(savefig_name, self._savefig_seconds, None)
+        self.stages[savefig_name]['figures'] = self.stages[savefig_name].get('figures', 0) + self._savefig_count
+
+    def _add(self, name, seconds, peak):
+        entry = self.stages.setdefault(name, {'seconds': 0.0, 'peak_mb': None})
+        entry['seconds'] += seconds
+        if peak is not None:
+            entry['peak_mb'] = max(entry['peak_mb'] or 0.0, peak / 2**20)
+
+
+def make_nachtt_dataset(months, n_variables, gap_fraction=0.1, seed=0):
+    """
+    Returns a synthetic NACHTT-shaped Dataset: 1-minute samples over the given number of (30-day) months,
+    with n_variables diurnally varying variables containing random NaN gaps and a few multi-hour outages.
+    """
+    rng = np.random.default_rng(seed)
+    time = pd.date_range('2011-02-15', periods=months * 30 * 1440, freq='1min')
+    hours = (time.hour + time.minute / 60).to_numpy()
+
+    data = {}
+    for i in range(n_variables):
+        diurnal = 1 + np.sin(2 * np.pi * (hours - 6 - i % 24) / 24)
+        values = (10 * diurnal + rng.gamma(2, 2, len(time))).astype('float64')
+        values[rng.random(len(time)) < gap_fraction] = np.nan
+        for start in rng.integers(0, len(time), size=months * 2):
+            values[start:start + 360] = np.nan
+        data[f'VAR{i:02d}'] = ('time', values)
+
+    return xr.Dataset(data, coords={'time': time})
+
+
+def make_species_conc_files(directory, days, species, resolution=(2.0, 2.5), n_lev=5, seed=0):
+    """
+    Writes one synthetic daily GEOS-Chem SpeciesConc file (hourly, time x lev x lat x lon) per day
+    and returns their paths.
+    """
+    rng = np.random.default_rng(seed)
+    lat = np.arange(-90, 90 + resolution[0] / 2, resolution[0])
+    lon = np.arange(-180, 180, resolution[1])
+    lev = np.linspace(0.99, 0.5, n_lev)
+
+    paths = []
+    for day in pd.date_range('2011-02-17', periods=days, freq='D'):
+        time = pd.date_range(day, periods=24, freq='h')
+        shape = (len(time), n_lev, len(lat), len(lon))
+        data = {f'SpeciesConcVV_{s}': (('time', 'lev', 'lat', 'lon'), (rng.random(shape) * 1e-9).astype('float32'))
+                for s in species}
+        path = os.path.join(directory, f'GEOSChem.SpeciesConc.{day:%Y%m%d}_0000z.nc4')
+        xr.Dataset(data, coords={'time': time, 'lev': lev, 'lat': lat, 'lon': lon}).to_netcdf(path)
+        paths.append(path)
+    return paths
+
+
+def bench_nachtt(directory, months, n_variables, max_figures=3, trace_memory=True):
+    """
+    Benchmarks the NACHTT pipeline on a synthetic dataset.
+
+    Parameters:
+    - directory: Directory for the synthetic NetCDF file and the saved figures.
+    - months: Length of the record in 30-day months.
+    - n_variables: Number of variables.
+    - max_figures: Number of variables drawn in the render/savefig stages.
+    - trace_memory: Record each stage's peak traced memory (slows the stages down somewhat).
+
+    Returns:
+    - result: dict with keys ['case', 'params', 'stages']
+    """
+    path = os.path.join(directory, f'nachtt_{months}m_{n_variables}v.nc')
+    make_nachtt_dataset(months, n_variables).to_netcdf(path)
+    variables = [f'VAR{i:02d}' for i in range(n_variables)]
+
+    cache = SeriesCache()
+    processor = Processor(cache=cache)
+    plotter = Plotter(cache=cache)
+    timer = StageTimer(trace_memory=trace_memory)
+
+    with timer.stage('load'):
+        dataset = Loader().open(path).load()
+
+    with timer.stage('time_conversion'):
+        cache.get_time_index(dataset, time_var='time', local_offset=-7)
+
+    # Each stage after time_conversion starts from an empty cache, so it pays for its own conversion and
+    # resampling instead of reusing the series an earlier stage left behind
+    cache.clear()
+    with timer.stage('aggregation'):
+        processor.get_diurnal_stats(dataset, variables, local_offset=-7)
+        for variable in variables:
+            cache.get_series(dataset, variable, local_offset=-7, average_interval='30min')
+
+    cache.clear()
+    with timer.stage('peaks'):
+        _, peaks = processor.get_peak_n_values(dataset, variables[0], average_interval='30min', local_offset=-7,
+                                               min_separation='24h')
+        processor.get_xlim_from_peaks(peaks.time, hours_before=12, hours_after=12)
+
+    drawn = variables[:max_figures]
+    cache.clear()
+    with timer.render_stage():
+        plotter.plot_diurnal_variations(dataset, drawn, local_offset=-7,
+                                        fig_save_path=os.path.join(directory, '{variable}_diurnal.png'))
+        for variable in drawn:
+            plotter.plot_time_series(dataset, variable, local_offset=-7, average_interval='30min',
+                                     fig_save_path=os.path.join(directory, f'{variable}_series.png'))
+
+    dataset.close()
+    return {'case': 'nachtt', 'params': {'months': months, 'variables': n_variables, 'samples': months * 30 * 1440,
+                                         'figures': 2 * len(drawn)},
+            'stages': timer.stages}
+
+
+def bench_species_conc(directory, days, n_species, n_sites=50, trace_memory=True):
+    """
+    Benchmarks the SpeciesConc reducer, the site extraction and base-map rendering on synthetic daily files.
+
+    Returns:
+    - result: dict with keys ['case', 'params', 'stages']
+    """
+    # Imported here so the NACHTT benchmarks run without cartopy
+    from GEOSChem_utils import GridIndex, get_base_map, reduce_species_conc
+
+    species = [f'S{i:02d}' for i in range(n_species)]
+    variables = [f'SpeciesConcVV_{s}' for s in species]
+    case_dir = os.path.join(directory, f'species_conc_{days}d_{n_species}s')
+    os.makedirs(case_dir, exist_ok=True)
+    paths = make_species_conc_files(case_dir, days, species)
+    timer = StageTimer(trace_memory=trace_memory)
+
+    with timer.stage('aggregation'):
+        reduced = reduce_species_conc(paths, variables, lev=0)
+
+    rng = np.random.default_rng(0)
+    sites = list(zip(rng.uniform(-60, 60, n_sites), rng.uniform(-180, 180, n_sites)))
+    with timer.stage('load'):
+        dataset = xr.open_dataset(paths[0])
+    with timer.stage('extraction'):
+        GridIndex.from_dataset(dataset).extract(dataset, sites, variables, lev=0).load()
+    dataset.close()
+
+    campaign_mean = reduced['campaign_mean']
+    with timer.render_stage():
+        base_map = get_base_map(campaign_mean['lon'].values, campaign_mean['lat'].values, (-180, 180, -90, 90),
+                                mesh_kwargs={'cmap': 'viridis'}, colorbar_kwargs={'orientation': 'horizontal'},
+                                autoscale=True)
+        for variable in variables:
+            base_map.update(campaign_mean[variable].values, title=variable)
+            base_map.save(os.path.join(case_dir, f'{variable}_mean.png'), dpi=150)
+
+    return {'case': 'species_conc', 'params': {'days': days, 'species': n_species, 'sites': n_sites,
+                                               'figures': len(variables)},
+            'stages': timer.stages}
+
+
+def environment():
+    """
+    Returns the versions and revision the benchmarks were run with.
+    """
+    import matplotlib as mpl
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                  cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        revision = None
+    return {'revision': revision, 'python': platform.python_version(), 'platform': platform.platform(),
+            'numpy': np.__version__, 'pandas': pd.__version__, 'xarray': xr.__version__, 'matplotlib': mpl.__version__,
+            'timestamp': pd.Timestamp.now().isoformat()}
+
+
+def compare(results, baseline, threshold=0.2, min_seconds=0.05):
+    """
+    Prints the stages that are more than threshold (fractionally) slower than in a baseline run.
+
+    Parameters:
+    - results, baseline: Benchmark JSON documents (dicts with a 'results' list).
+    - threshold: Allowed fractional slowdown (default 0.2, i.e. 20 %).
+    - min_seconds: Stages shorter than this in the baseline are too noisy to compare and are skipped.
+
+    Returns:
+    - regressions: list of (case, params, stage, baseline seconds, new seconds)
+    """
+    def key(result):
+        return result['case'], json.dumps(result['params'], sort_keys=True)
+
+    previous = {key(r): r for r in baseline['results']}
+    regressions = []
+    for result in results['results']:
+        old = previous.get(key(result))
+        if old is None:
+            continue
+        for stage, entry in result['stages'].items():
+            old_seconds = old['stages'].get(stage, {}).get('seconds')
+            if old_seconds is None or old_seconds < min_seconds:
+                continue
+            if entry['seconds'] > old_seconds * (1 + threshold):
+                regressions.append((result['case'], result['params'], stage, old_seconds, entry['seconds']))
+
+    for case, params, stage, old_seconds, new_seconds in regressions:
+        print(f'REGRESSION {case} {params} {stage}: {old_seconds:.3f} s -> {new_seconds:.3f} s '
+              f'({new_seconds / old_seconds - 1:+.0%})')
+    if not regressions:
+        print(f'No stage slower than the baseline by more than {threshold:.0%}')
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--months', type=int, nargs='+', default=[1, 6], help='NACHTT record lengths (30-day months)')
+    parser.add_argument('--variables', type=int, nargs='+', default=[1, 10], help='NACHTT variable counts')
+    parser.add_argument('--max-figures', type=int, default=3, help='NACHTT variables drawn per case')
+    parser.add_argument('--days', type=int, nargs='+', default=[3], help='SpeciesConc file counts (days)')
+    parser.add_argument('--species', type=int, nargs='+', default=[4], help='SpeciesConc species counts')
+    parser.add_argument('--skip-species-conc', action='store_true', help='Only run the NACHTT benchmarks')
+    parser.add_argument('--no-memory', action='store_true', help='Do not trace memory (faster, less intrusive timings)')
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON file to write')
+    parser.add_argument('--compare', help='Previous JSON results to check for regressions')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Allowed fractional slowdown for --compare')
+    args = parser.parse_args(argv)
+
+    trace_memory = not args.no_memory
+    results = []
+    with tempfile.TemporaryDirectory(prefix='nachtt_bench_') as directory:
+        for months in args.months:
+            for n_variables in args.variables:
+                print(f'nachtt: {months} month(s), {n_variables} variable(s)')
+                results.append(bench_nachtt(directory, months, n_variables, max_figures=args.max_figures,
+                                            trace_memory=trace_memory))
+        if not args.skip_species_conc:
+            for days in args.days:
+                for n_species in args.species:
+                    print(f'species_conc: {days} day(s), {n_species} species')
+                    results.append(bench_species_conc(directory, days, n_species, trace_memory=trace_memory))
+
+    for result in results:
+        for stage, entry in result['stages'].items():
+            peak = f", peak {entry['peak_mb']:.1f} MB" if entry['peak_mb'] is not None else ''
+            print(f"  {result['case']} {result['params']} {stage}: {entry['seconds']:.3f} s{peak}")
+
+    document = {'environment': environment(), 'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(document, f, indent=1)
+    print(f'Wrote {args.output}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        return 1 if compare(document, baseline, threshold=args.threshold) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,186 @@
+import atexit
+import cProfile
+import functools
+import os
+import pstats
+import time
+from collections import defaultdict
+
+
+class _NullStage:
+    # Shared do-nothing context manager returned while instrumentation is disabled
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        timer = self.instrumentation.timers[self.name]
+        timer[0] += 1
+        timer[1] += time.perf_counter() - self.start
+        return False
+
+
+class Instrumentation:
+    """
+    Opt-in timers and counters for the Plotter/Processor hot paths: per-stage wall time
+    (e.g. 'to_datetime', 'resample', 'groupby', 'draw', 'savefig'), bytes read per variable,
+    series cache hits/misses and figure counts.
+
+    While disabled (the default) every hook returns immediately, so the instrumented code
+    pays one attribute check per call.
+
+    Example:
+        with instrument.session(profile_path='nachtt.prof'):
+            plotter.plot_time_series(...)
+        # -> prints the summary and writes a cProfile dump (view with `python -m pstats nachtt.prof`)
+
+    Setting the environment variable NACHTT_INSTRUMENT=1 (or to a .prof path, to also profile)
+    enables instrumentation for the whole script and prints the summary when it exits.
+    """
+    def __init__(self):
+        self.enabled = False
+        self._profiler = None
+        self._profile_path = None
+        self.reset()
+
+    def reset(self):
+        # name -> [calls, seconds]
+        self.timers = defaultdict(lambda: [0, 0.0])
+        self.counters = defaultdict(int)
+        self.bytes_read = defaultdict(int)
+
+    def enable(self, profile_path=None, report_at_exit=False):
+        """
+        Starts recording. With profile_path, a cProfile profiler also runs until disable() and its
+        stats are dumped to that path. With report_at_exit, the summary is printed when the interpreter exits.
+        """
+        self.enabled = True
+        if profile_path and self._profiler is None:
+            self._profile_path = profile_path
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        if report_at_exit:
+            atexit.register(self._report_at_exit)
+
+    def disable(self):
+        """
+        Stops recording (keeping what was recorded) and writes the cProfile dump if one was requested.
+        """
+        self.enabled = False
+        if self._profiler is not None:
+            self._profiler.disable()
+            self._profiler.dump_stats(self._profile_path)
+            self._profiler = None
+
+    def session(self, profile_path=None, report=True, reset=True):
+        """
+        Returns a context manager that enables instrumentation for its block, then disables it and
+        prints the summary (with report=True). reset=True clears earlier records first.
+        """
+        return _Session(self, profile_path, report, reset)
+
+    def stage(self, name):
+        """
+        Returns a context manager timing its block under name (a no-op while disabled).
+        """
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def timed(self, name=None):
+        """
+        Decorator timing every call of the function under name (default: its qualified name).
+        """
+        def decorate(func):
+            label = name or func.__qualname__
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with _Stage(self, label):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] += n
+
+    def add_bytes(self, variable, nbytes):
+        """
+        Records nbytes materialized (read from disk or from the lazy dataset) for variable.
+        """
+        if self.enabled:
+            self.bytes_read[variable] += int(nbytes)
+
+    def summary(self):
+        """
+        Returns the recorded timers, counters and bytes read as a printable report.
+        """
+        lines = ['Instrumentation summary', f"{'stage':<40}{'calls':>8}{'total s':>12}{'mean ms':>12}"]
+        for name, (calls, seconds) in sorted(self.timers.items(), key=lambda item: -item[1][1]):
+            lines.append(f'{name:<40}{calls:>8}{seconds:>12.3f}{1000 * seconds / calls:>12.2f}')
+
+        if self.counters:
+            lines.append('')
+            lines.extend(f'{name:<40}{value:>8}' for name, value in sorted(self.counters.items()))
+
+        if self.bytes_read:
+            lines.append('')
+            lines.append(f"{'bytes read':<40}{'MB':>8}")
+            for variable, nbytes in sorted(self.bytes_read.items(), key=lambda item: -item[1]):
+                lines.append(f'{variable:<40}{nbytes / 2**20:>8.1f}')
+        return '\n'.join(lines)
+
+    def _report_at_exit(self):
+        self.disable()
+        print(self.summary())
+        if self._profile_path:
+            print(f'cProfile stats written to {self._profile_path}')
+            pstats.Stats(self._profile_path).sort_stats('cumulative').print_stats(15)
+
+
+class _Session:
+    def __init__(self, instrumentation, profile_path, report, reset):
+        self.instrumentation = instrumentation
+        self.profile_path = profile_path
+        self.report = report
+        self.reset = reset
+
+    def __enter__(self):
+        if self.reset:
+            self.instrumentation.reset()
+        self.instrumentation.enable(profile_path=self.profile_path)
+        return self.instrumentation
+
+    def __exit__(self, *exc):
+        self.instrumentation.disable()
+        if self.report:
+            print(self.instrumentation.summary())
+            if self.profile_path:
+                print(f'cProfile stats written to {self.profile_path}')
+        return False
+
+
+# Process-wide instrumentation shared by NACHTT_utils and GEOSChem_utils
+instrument = Instrumentation()
+
+_env = os.environ.get('NACHTT_INSTRUMENT')
+if _env and _env != '0':
+    instrument.enable(profile_path=None if _env == '1' else _env, report_at_exit=True)
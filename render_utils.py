@@ -0,0 +1,321 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import matplotlib
+import numpy as np
+
+try:
+    import dask
+except ImportError:
+    dask = None
+
+
+def _init_worker():
+    # Workers only ever write files, so force the non-interactive Agg backend
+    matplotlib.use('Agg', force=True)
+
+    # A forked worker inherits dask's thread pool without its threads; each worker is already
+    # one core's worth of work, so compute lazy (dask) data synchronously
+    if dask is not None:
+        dask.config.set(scheduler='synchronous')
+
+
+def _run_job(func, args, kwargs, in_worker=True):
+    import matplotlib.pyplot as plt
+
+    # In the caller's process, figures that existed before the job belong to the user
+    existing = None if in_worker else set(plt.get_fignums())
+    start = time.perf_counter()
+    try:
+        result = func(*args, **kwargs)
+        return True, result, None, time.perf_counter() - start
+    except Exception:
+        return False, None, traceback.format_exc(), time.perf_counter() - start
+    finally:
+        # Never let a failed or show()-ending job leak figures into the next one
+        if in_worker:
+            plt.close('all')
+        else:
+            for num in set(plt.get_fignums()) - existing:
+                plt.close(num)
+
+
+class RenderPool:
+    """
+    Renders figure jobs (any picklable callable that draws and saves a figure) across a pool of
+    worker processes using the Agg backend, reporting progress and failures per job.
+
+    Example:
+        pool = RenderPool(workers=8)
+        for path in nc_files:
+            pool.submit(render_file, path, label=os.path.basename(path))
+        results = pool.run()
+    """
+    def __init__(self, workers=None, verbose=True):
+        # workers: number of worker processes (default: all cores); 1 (or a single job) renders serially
+        # in this process, with its current backend, closing only the figures each job opened
+        self.workers = workers if workers else os.cpu_count()
+        self.verbose = verbose
+        self.jobs = []
+
+    def submit(self, func, *args, label=None, **kwargs):
+        """
+        Queues func(*args, **kwargs) to run when run() is called. label names the job in progress output.
+        """
+        self.jobs.append((label if label is not None else f'job {len(self.jobs)}', func, args, kwargs))
+
+    def run(self):
+        """
+        Runs every queued job and clears the queue.
+
+        Returns:
+        - results: list (in submission order) of dicts with keys ['label', 'ok', 'result', 'error', 'seconds']
+        """
+        jobs, self.jobs = self.jobs, []
+        results = [None] * len(jobs)
+
+        if self.workers == 1 or len(jobs) <= 1:
+            for i, (label, func, args, kwargs) in enumerate(jobs):
+                results[i] = self._report(i, len(jobs), label, *_run_job(func, args, kwargs, in_worker=False))
+            return results
+
+        # Fork where available so scripts without a __main__ guard are not re-executed by each worker
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=context, initializer=_init_worker) as executor:
+            futures = {executor.submit(_run_job, func, args, kwargs): i for i, (_, func, args, kwargs) in enumerate(jobs)}
+            for done, future in enumerate(as_completed(futures), start=1):
+                i = futures[future]
+                try:
+                    outcome = future.result()
+                except Exception:
+                    # The job (or its result) could not be sent to or from the worker
+                    outcome = (False, None, traceback.format_exc(), 0.0)
+                results[i] = self._report(done - 1, len(jobs), jobs[i][0], *outcome)
+
+        failed = sum(not r['ok'] for r in results)
+        if self.verbose and failed:
+            print(f'{failed} of {len(jobs)} render jobs failed')
+        return results
+
+    def _report(self, index, total, label, ok, result, error, seconds):
+        if self.verbose:
+            status = f'done in {seconds:.1f} s' if ok else f'FAILED\n{error}'
+            print(f'[{index + 1}/{total}] {label}: {status}')
+        return {'label': label, 'ok': ok, 'result': result, 'error': error, 'seconds': seconds}
+
+
+class BuildManifest:
+    """
+    Records, for each output figure, a hash of its input files and of the arguments it was drawn with,
+    so re-runs can skip figures that are already up to date.
+
+    Input files are fingerprinted by (mtime, size) first; only when those change is the file's content
+    re-hashed, so touching a file without changing it does not trigger a re-render.
+    """
+    def __init__(self, path='figure_manifest.json'):
+        self.path = path
+        self.outputs = {}
+        self.files = {}
+        # Set when a file was re-hashed since the last save
+        self._refreshed = False
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            self.outputs = state.get('outputs', {})
+            self.files = state.get('files', {})
+
+    def file_hash(self, path):
+        """
+        Returns the content hash of a file, reusing the recorded hash while its mtime and size are unchanged.
+        """
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        entry = self.files.get(path)
+        if entry is not None and entry['mtime'] == st.st_mtime_ns and entry['size'] == st.st_size:
+            return entry['sha1']
+
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(2**20), b''):
+                sha1.update(block)
+        self.files[path] = {'mtime': st.st_mtime_ns, 'size': st.st_size, 'sha1': sha1.hexdigest()}
+        self._refreshed = True
+        return self.files[path]['sha1']
+
+    @staticmethod
+    def params_hash(params):
+        """
+        Returns a stable hash of the plot arguments (anything without a JSON form is hashed by repr).
+        """
+        text = json.dumps(params, sort_keys=True, default=repr)
+        return hashlib.sha1(text.encode()).hexdigest()
+
+    def is_up_to_date(self, output_path, inputs, params):
+        """
+        Returns True if output_path exists and was last recorded with the same input file contents and params.
+        """
+        entry = self.outputs.get(os.path.abspath(output_path))
+        if entry is None or not os.path.exists(output_path) or not inputs:
+            return False
+        if entry['params'] != self.params_hash(params):
+            return False
+        try:
+            current = {os.path.abspath(path): self.file_hash(path) for path in inputs}
+        except OSError:
+            return False
+        up_to_date = current == entry['inputs']
+        if up_to_date and self._refreshed:
+            # A touched but unchanged input was re-hashed; keep its new fingerprint so the next run
+            # does not hash it again even if nothing is re-rendered (and record() never saves)
+            self.save()
+        return up_to_date
+
+    def record(self, output_path, inputs, params, save=True):
+        """
+        Records that output_path was rendered from inputs with params (and saves the manifest by default).
+        """
+        self.outputs[os.path.abspath(output_path)] = {
+            'inputs': {os.path.abspath(path): self.file_hash(path) for path in inputs},
+            'params': self.params_hash(params),
+        }
+        if save:
+            self.save()
+
+    def save(self):
+        # Merge with what is on disk first, so render workers recording into the same manifest do not
+        # drop each other's entries, then replace the file atomically
+        outputs, files = {}, {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                state = json.load(f)
+            outputs, files = state.get('outputs', {}), state.get('files', {})
+        outputs.update(self.outputs)
+        files.update(self.files)
+
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'outputs': outputs, 'files': files}, f, indent=1)
+        os.replace(tmp_path, self.path)
+        self._refreshed = False
+
+
+def dataset_sources(dataset):
+    """
+    Returns the list of files an xarray Dataset was opened from (empty if unknown, e.g. built in memory).
+    """
+    encoding = getattr(dataset, 'encoding', {})
+    if encoding.get('sources'):
+        return list(encoding['sources'])
+    return [encoding['source']] if encoding.get('source') else []
+
+
+class FrameWriter:
+    """
+    Streams frames drawn on one reused Figure (e.g. a GEOSChem_utils.BaseMap whose data is swapped per
+    day) into a single output, instead of encoding and writing one full-resolution PNG per frame:
+    - '.gif': animated GIF (Pillow)
+    - '.mp4' (or other video extensions): video through ffmpeg, which must be on the PATH
+    - '.png', '.jpg', ...: a tiled contact sheet, with each frame downscaled into a preallocated
+      grid and the sheet encoded once when the writer is closed
+
+    Example:
+        with FrameWriter(base_map.fig, 'dust_march.gif', fps=4) as writer:
+            for day, mask in masks:
+                base_map.update(mask, title=day)
+                writer.add_frame()
+    """
+    def __init__(self, fig, path, fps=4, dpi=100, columns=6, tile_width=640, n_frames=None):
+        """
+        Parameters:
+        - fig: The matplotlib Figure redrawn for every frame.
+        - path: Output file; its extension selects the format.
+        - fps: Frames per second of an animation.
+        - dpi: Resolution the frames are rendered at.
+        - columns, tile_width: Contact sheet layout (tiles per row, tile width in pixels).
+        - n_frames: Expected number of frames of a contact sheet (the sheet grows if more are added).
+        """
+        self.fig = fig
+        self.path = path
+        self.dpi = dpi
+        self.columns = min(columns, n_frames) if n_frames else columns
+        self.tile_width = tile_width
+        self.n_frames = 0
+
+        extension = os.path.splitext(path)[1].lower()
+        self.kind = 'gif' if extension == '.gif' else 'video' if extension in ('.mp4', '.mov', '.avi', '.mkv') else 'sheet'
+
+        self._writer = None
+        self._sheet = None
+        self._expected = n_frames
+        if self.kind != 'sheet':
+            from matplotlib import animation
+            if self.kind == 'gif':
+                self._writer = animation.PillowWriter(fps=fps)
+            elif animation.FFMpegWriter.isAvailable():
+                self._writer = animation.FFMpegWriter(fps=fps)
+            else:
+                raise RuntimeError(f'Writing {path} needs ffmpeg on the PATH; use a .gif or contact-sheet image instead')
+            self._writer.setup(fig, path, dpi=dpi)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def add_frame(self):
+        """
+        Renders the figure's current state as the next frame.
+        """
+        if self._writer is not None:
+            self._writer.grab_frame()
+        else:
+            self._add_tile()
+        self.n_frames += 1
+
+    def _add_tile(self):
+        # Draw into the figure's own canvas buffer at the frame resolution and downscale by striding
+        original_dpi = self.fig.dpi
+        self.fig.set_dpi(self.dpi)
+        try:
+            self.fig.canvas.draw()
+            frame = np.asarray(self.fig.canvas.buffer_rgba())
+        finally:
+            self.fig.set_dpi(original_dpi)
+
+        step = max(1, int(np.ceil(frame.shape[1] / self.tile_width)))
+        tile = frame[::step, ::step, :3]
+
+        if self._sheet is None:
+            rows = -(-(self._expected or self.columns) // self.columns)
+            self._tile_shape = tile.shape
+            self._sheet = np.full((rows * tile.shape[0], self.columns * tile.shape[1], 3), 255, dtype=np.uint8)
+
+        h, w = self._tile_shape[:2]
+        row, column = divmod(self.n_frames, self.columns)
+        if (row + 1) * h > self._sheet.shape[0]:
+            grown = np.full(((row + 1) * h, self._sheet.shape[1], 3), 255, dtype=np.uint8)
+            grown[:self._sheet.shape[0]] = self._sheet
+            self._sheet = grown
+        self._sheet[row * h:(row + 1) * h, column * w:(column + 1) * w] = tile[:h, :w]
+
+    def close(self):
+        """
+        Finishes the animation, or encodes and writes the contact sheet.
+        """
+        if self._writer is not None:
+            self._writer.finish()
+            self._writer = None
+        elif self._sheet is not None:
+            from matplotlib import image
+            rows = -(-self.n_frames // self.columns)
+            image.imsave(self.path, self._sheet[:rows * self._tile_shape[0]])
+            self._sheet = None
@@ -0,0 +1,324 @@
+import io
+import multiprocessing
+import os
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import matplotlib.dates as mdates
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.backends.backend_pdf import PdfPages
+
+from NACHTT_utils import Loader, Plotter, SeriesCache, _per_variable
+from profiling_utils import instrument
+from render_utils import _init_worker
+
+try:
+    import pypdf
+except ImportError:
+    pypdf = None
+
+
+# Datasets opened by this process, keyed on (source, time_var); each worker opens a file once for all its pages
+_datasets = {}
+_plotter = None
+
+
+def _open_source(source, time_var='time'):
+    key = (tuple(source) if isinstance(source, (list, tuple)) else source, time_var)
+    if key not in _datasets:
+        _datasets[key] = Loader().open(source, time_var=time_var)
+    return _datasets[key]
+
+
+def _get_plotter():
+    global _plotter
+    if _plotter is None:
+        # Its own cache, so closing the report's datasets never touches the caller's cached series
+        _plotter = Plotter(cache=SeriesCache(), headless=True)
+    return _plotter
+
+
+def _close_datasets():
+    # Releases the file handles (and cached series) of every dataset the report opened in this process
+    for dataset in _datasets.values():
+        dataset.close()
+    _datasets.clear()
+    if _plotter is not None:
+        _plotter.cache.clear()
+
+
+def _draw_diurnal_panel(fig, cell, panel):
+    plotter = _get_plotter()
+    dataset = _open_source(panel['source'], panel.get('time_var', 'time'))
+    variable = panel['variable']
+    stats = plotter.processor.get_diurnal_stats(dataset, [variable], scale_factor=panel.get('scale_factor', 1),
+                                                time_var=panel.get('time_var', 'time'),
+                                                local_offset=panel.get('local_offset', 0))[variable]
+
+    second_stats = None
+    if panel.get('second_source') is not None:
+        second_variable = panel['second_variable']
+        second_time_var = panel.get('second_time_var', 'time_UTC')
+        second_stats = plotter.processor.get_diurnal_stats(_open_source(panel['second_source'], second_time_var), [second_variable],
+                                                           scale_factor=panel.get('second_scale_factor', 1), time_var=second_time_var,
+                                                           local_offset=panel.get('local_offset', 0))[second_variable]
+
+    plotter.draw_diurnal_on(fig.add_subplot(cell), stats, variable, local_offset=panel.get('local_offset', 0),
+                            ylabel=panel.get('ylabel'), primary_ylim=panel.get('ylim'), second_stats=second_stats,
+                            second_variable_name=panel.get('second_variable'), second_ylabel=panel.get('second_ylabel'),
+                            secondary_ylim=panel.get('second_ylim'))
+
+
+def _draw_time_series_panel(fig, cell, panel):
+    plotter = _get_plotter()
+    time_var = panel.get('time_var', 'time')
+    dataset = _open_source(panel['source'], time_var)
+    options = dict(scale_factor=panel.get('scale_factor', 1), time_var=time_var, local_offset=panel.get('local_offset', 0),
+                   average_interval=panel.get('average_interval'))
+    xlim = panel.get('xlim')
+    if xlim is not None:
+        series = plotter.processor.get_window_series(dataset, panel['variable'], xlim[0], xlim[1], **options)
+    else:
+        series = plotter.cache.get_series(dataset, panel['variable'], **options)
+
+    plotter.draw_time_series_on(fig.add_subplot(cell), series, panel['variable'], ylabel=panel.get('ylabel', 'Observed'),
+                                average_interval=panel.get('average_interval'), xlim=xlim, ylim=panel.get('ylim'),
+                                decimate=panel.get('decimate', True))
+
+
+def _draw_peaks_panel(fig, cell, panel):
+    # The top-n events, each zoomed to +/- hours around its peak, in a row of sub-panels
+    plotter = _get_plotter()
+    processor = plotter.processor
+    time_var = panel.get('time_var', 'time')
+    dataset = _open_source(panel['source'], time_var)
+    options = dict(time_var=time_var, local_offset=panel.get('local_offset', 0), average_interval=panel.get('average_interval'))
+
+    _, peaks = processor.get_peak_n_values(dataset, panel['variable'], n=panel.get('n', 5),
+                                           min_separation=panel.get('min_separation', '24h'), **options)
+    hours = panel.get('hours', 12)
+    windows = processor.get_xlim_from_peaks(peaks.time, hours_before=hours, hours_after=hours)
+    if not windows:
+        ax = fig.add_subplot(cell)
+        ax.text(0.5, 0.5, f"No valid data for {panel['variable']}", ha='center', va='center', transform=ax.transAxes)
+        return
+
+    grid = cell.subgridspec(1, len(windows), wspace=0.3)
+    for i, (start, end) in enumerate(windows):
+        series = processor.get_window_series(dataset, panel['variable'], start, end, scale_factor=panel.get('scale_factor', 1), **options)
+        ax = fig.add_subplot(grid[0, i])
+        plotter.draw_time_series_on(ax, series, panel['variable'], ylabel=panel.get('ylabel', 'Observed') if i == 0 else '',
+                                    average_interval=panel.get('average_interval'), xlim=(start, end), decimate=True)
+        ax.set_title(f'{start + pd.Timedelta(hours=hours):%Y-%m-%d %H:%M}', fontsize=8)
+        ax.set_xlabel('')
+        ax.get_legend().remove()
+        ax.xaxis.set_major_locator(mdates.AutoDateLocator(maxticks=4))
+        ax.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
+        ax.tick_params(axis='x', labelsize=7)
+
+
+def _draw_map_panel(fig, cell, panel):
+    # Imported here so NACHTT-only reports do not need cartopy
+    import cartopy.crs as ccrs
+    from GEOSChem_utils import open_region
+
+    extent = panel.get('extent', (-180, 180, -90, 90))
+    sources = panel['source'] if isinstance(panel['source'], (list, tuple)) else [panel['source']]
+    total, count = 0, 0
+    for source in sources:
+        with open_region(source, extent, variables=[panel['variable']]) as ds:
+            data = ds[panel['variable']]
+            if panel.get('lev') is not None and 'lev' in data.dims:
+                data = data.isel(lev=panel['lev'])
+            reduce_dims = [dim for dim in data.dims if dim not in ('lat', 'lon')]
+            values = data.transpose(*reduce_dims, 'lat', 'lon').values.reshape(-1, data.sizes['lat'], data.sizes['lon'])
+            total = total + np.nansum(values, axis=0)
+            count = count + np.sum(~np.isnan(values), axis=0)
+            lon, lat = ds['lon'].values, ds['lat'].values
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(count > 0, total / count, np.nan) * panel.get('scale_factor', 1)
+
+    ax = fig.add_subplot(cell, projection=ccrs.PlateCarree())
+    ax.set_extent(list(extent), crs=ccrs.PlateCarree())
+    mesh = ax.pcolormesh(lon, lat, np.ma.masked_invalid(mean), transform=ccrs.PlateCarree(), cmap=panel.get('cmap', 'viridis'))
+    if panel.get('background') is not None:
+        panel['background'](ax)
+    fig.colorbar(mesh, ax=ax, orientation='horizontal', pad=0.05, label=panel.get('label', panel['variable']))
+    ax.set_title(panel.get('title', f"Mean {panel['variable']}"))
+
+
+# Panel kinds understood by ReportBuilder pages
+PANEL_DRAWERS = {
+    'diurnal': _draw_diurnal_panel,
+    'time_series': _draw_time_series_panel,
+    'peaks': _draw_peaks_panel,
+    'map': _draw_map_panel,
+}
+
+
+def _failed_page(message, figsize=(8.5, 11)):
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    fig.text(0.05, 0.95, message, va='top', family='monospace', fontsize=6)
+    return fig
+
+
+def _pdf_bytes(fig):
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='pdf')
+    return buffer.getvalue()
+
+
+def _render_page(page, as_pdf=False):
+    # Builds one page as a pyplot-less figure; failures become a page showing the traceback.
+    # With as_pdf, the page is also drawn here and returned as single-page PDF bytes
+    start = time.perf_counter()
+    figsize = page.get('figsize', (8.5, 11))
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    try:
+        panels = page['panels']
+        columns = page.get('columns', 1)
+        rows = -(-len(panels) // columns)
+        grid = fig.add_gridspec(rows, columns, hspace=0.45, wspace=0.3)
+        for i, panel in enumerate(panels):
+            PANEL_DRAWERS[panel['kind']](fig, grid[i // columns, i % columns], panel)
+        if page.get('title'):
+            fig.suptitle(page['title'], fontsize=14)
+        ok, error = True, None
+    except Exception:
+        error = traceback.format_exc()
+        fig = _failed_page(f"Page '{page.get('title', '')}' failed:\n\n{error}", figsize)
+        ok = False
+
+    if as_pdf:
+        try:
+            fig = _pdf_bytes(fig)
+        except Exception:
+            error = traceback.format_exc()
+            fig = _pdf_bytes(_failed_page(f"Page '{page.get('title', '')}' failed:\n\n{error}", figsize))
+            ok = False
+    return fig, ok, error, time.perf_counter() - start
+
+
+class ReportBuilder:
+    """
+    Builds a multi-page PDF report from a declarative list of pages, each a grid of panels.
+
+    Pages are rendered in worker processes (each keeping its opened datasets for later pages) and
+    collected in page order; at most max_in_flight pages are queued or held as figures at a time.
+    With pypdf installed, each worker also draws its page into a single-page PDF and the parent only
+    appends those pages, so the whole build scales with the number of workers. Without pypdf the
+    workers return the figures and the PDF drawing (usually the larger part of the work) runs
+    serially in the parent through matplotlib's PdfPages.
+
+    A panel is a dict with a 'kind' and its options:
+    - 'diurnal': source, variable, time_var, local_offset, scale_factor, ylabel, ylim, and optionally
+      second_source, second_variable, second_time_var, second_scale_factor, second_ylabel, second_ylim
+    - 'time_series': source, variable, time_var, local_offset, scale_factor, average_interval, xlim, ylim, ylabel, decimate
+    - 'peaks': source, variable, time_var, local_offset, scale_factor, average_interval, n, hours, min_separation, ylabel
+    - 'map': source (file or list of files), variable, extent, lev, scale_factor, cmap, label, title, background
+    source is a file path (or list/glob) opened with NACHTT_utils.Loader; panels must be picklable.
+
+    Example:
+        report = ReportBuilder('../figures/NACHTT_report.pdf')
+        report.add_species_pages(nachtt_nc_file, ['ClNO2_pptv', 'N2O5_pptv'], local_offset=-7, average_interval='30min')
+        report.build()
+    """
+    def __init__(self, path, workers=None, max_in_flight=None, verbose=True):
+        self.path = path
+        self.workers = workers if workers else os.cpu_count()
+        # Pages submitted but not yet written; bounds memory held by rendered figures
+        self.max_in_flight = max_in_flight if max_in_flight else 2 * self.workers
+        self.verbose = verbose
+        self.pages = []
+
+    def add_page(self, panels, title=None, columns=1, figsize=(8.5, 11)):
+        """
+        Appends a page with the given panels (dicts, see the class docstring), laid out in a grid with columns columns.
+        """
+        unknown = [panel.get('kind') for panel in panels if panel.get('kind') not in PANEL_DRAWERS]
+        if unknown:
+            raise ValueError(f'Unknown panel kind(s) {unknown}; expected one of {sorted(PANEL_DRAWERS)}')
+        self.pages.append({'panels': list(panels), 'title': title, 'columns': columns, 'figsize': figsize})
+
+    def add_species_pages(self, source, variables, kinds=('diurnal', 'time_series', 'peaks'), title=None, **options):
+        """
+        Appends one page per variable with one panel of each kind, sharing options (time_var, local_offset,
+        average_interval, ...). Options given as dicts keyed by variable name apply per variable.
+        """
+        for variable in variables:
+            shared = {key: _per_variable(value, variable) for key, value in options.items()}
+            panels = [dict(shared, kind=kind, source=source, variable=variable) for kind in kinds]
+            self.add_page(panels, title=(title or '{variable}').format(variable=variable))
+
+    def build(self):
+        """
+        Renders every page and writes the PDF, in page order.
+
+        Returns:
+        - n_failed: Number of pages whose panels failed (they are written as traceback pages).
+        """
+        pages, n_failed = self.pages, 0
+        # Merging worker-drawn PDF pages needs pypdf; otherwise figures come back and are drawn here
+        as_pdf = pypdf is not None and self.workers != 1 and len(pages) > 1
+        if as_pdf:
+            writer = pypdf.PdfWriter()
+            add_page = lambda data: writer.append(pypdf.PdfReader(io.BytesIO(data)))
+        else:
+            pdf = PdfPages(self.path)
+            add_page = pdf.savefig
+
+        try:
+            for index, (page, ok, error, seconds) in enumerate(self._rendered(pages, as_pdf)):
+                with instrument.stage('append_page' if as_pdf else 'savefig'):
+                    add_page(page)
+                instrument.count('figures')
+                n_failed += not ok
+                if self.verbose:
+                    status = f'done in {seconds:.1f} s' if ok else f'FAILED\n{error}'
+                    print(f"[{index + 1}/{len(pages)}] {pages[index].get('title') or 'page'}: {status}")
+                del page
+        finally:
+            if as_pdf:
+                with open(self.path, 'wb') as f:
+                    writer.write(f)
+            else:
+                pdf.close()
+            # Pages drawn here (serial builds, or datasets opened before forking) keep their files open until now
+            _close_datasets()
+
+        if self.verbose:
+            print(f'Wrote {len(pages)} pages to {self.path}' + (f' ({n_failed} failed)' if n_failed else ''))
+        return n_failed
+
+    def _rendered(self, pages, as_pdf=False):
+        # Yields rendered pages in order, keeping at most max_in_flight pages submitted ahead
+        if self.workers == 1 or len(pages) <= 1:
+            for page in pages:
+                yield _render_page(page, as_pdf)
+            return
+
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=context, initializer=_init_worker) as executor:
+            pending = deque()
+            next_page = 0
+            while next_page < len(pages) or pending:
+                while next_page < len(pages) and len(pending) < self.max_in_flight:
+                    pending.append(executor.submit(_render_page, pages[next_page], as_pdf))
+                    next_page += 1
+                future = pending.popleft()
+                try:
+                    yield future.result()
+                except Exception:
+                    # The page (or its figure) could not be sent to or from the worker
+                    error = traceback.format_exc()
+                    fig = _failed_page(error)
+                    yield _pdf_bytes(fig) if as_pdf else fig, False, error, 0.0